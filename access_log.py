@@ -0,0 +1,97 @@
+"""Access log written off the request thread.
+
+Requests put their log record on a queue through a QueueHandler; a background
+thread per worker drains the queue and writes whole batches to stderr with a
+single write. Records are dropped rather than blocking a request when the
+queue is full. Sampling and a slow-request threshold cut the volume further.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from os import environ, getpid
+
+ACCESS_LOG_SAMPLE_RATE = float(environ.get('FORUM_ACCESS_LOG_SAMPLE_RATE', 1))
+ACCESS_LOG_SLOW_THRESHOLD = float(environ.get('FORUM_ACCESS_LOG_SLOW_THRESHOLD', 0))
+ACCESS_LOG_QUEUE_SIZE = int(environ.get('FORUM_ACCESS_LOG_QUEUE_SIZE', 10000))
+ACCESS_LOG_BATCH_SIZE = 256
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, writer):
+        super().__init__(None)
+        self.writer = writer
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.writer.queue().put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchWriter:
+    """Background thread writing queued records to `stream` in batches."""
+
+    _stop = object()
+
+    def __init__(self, stream, maxsize, batch_size):
+        self.stream = stream
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self._process_id = None
+
+    def queue(self):
+        if self._process_id != getpid():
+            # records queued in the parent are the parent's to write
+            self._queue = queue.Queue(self.maxsize)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._process_id = getpid()
+            self._thread.start()
+        return self._queue
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is self._stop
+            lines = [record.getMessage() + '\n' for record in batch if record is not self._stop]
+            if lines:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            if stop:
+                return
+
+    def close(self, timeout=5):
+        """Write out everything queued so far; called at worker exit."""
+        if self._process_id == getpid() and self._thread.is_alive():
+            try:
+                self._queue.put(self._stop, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+
+writer = BatchWriter(sys.stderr, ACCESS_LOG_QUEUE_SIZE, ACCESS_LOG_BATCH_SIZE)
+handler = DroppingQueueHandler(writer)
+atexit.register(writer.close)
+
+logger = logging.getLogger('forum.access')
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+
+def log_request(seconds, method, path, status):
+    if seconds < ACCESS_LOG_SLOW_THRESHOLD:
+        return
+    if ACCESS_LOG_SAMPLE_RATE < 1 and random.random() >= ACCESS_LOG_SAMPLE_RATE:
+        return
+    logger.info('%.5fs %s %s %s', seconds, method, path, status)
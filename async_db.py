@@ -0,0 +1,164 @@
+"""Database access for async_main on psycopg2's asynchronous connections.
+
+Connections are opened with `async_=True`: every call returns at once and
+the connection's socket is handed to the event loop with add_reader or
+add_writer until `poll()` reports the operation done. No thread blocks on a
+query, so one process keeps up to ASYNC_POOL_SIZE queries in flight.
+
+Asynchronous connections are always in autocommit mode and have no named
+cursors or COPY, which is why only single-statement reads run here, and why
+`fetch_chunks` declares its server-side cursor in SQL.
+"""
+import asyncio
+import time
+from itertools import count
+from os import environ
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import metrics
+import statements
+from connect_db import DB_SETTINGS, REPLICA_DSNS, ForumConnection
+
+ASYNC_POOL_SIZE = int(environ.get('FORUM_ASYNC_POOL_SIZE', 100))
+
+
+async def wait(conn):
+    """Drive `conn.poll()` on the event loop until the pending operation is done."""
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f'poll() returned {state}')
+
+        ready = loop.create_future()
+        fileno = conn.fileno()
+        add(fileno, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fileno)
+
+
+class AsyncPool:
+    """At most `size` asynchronous connections, opened on demand."""
+
+    def __init__(self, size, **kwargs):
+        self.size = size
+        self.kwargs = kwargs
+        self.opened = 0
+        self._idle = None
+
+    async def _connect(self):
+        conn = psycopg2.connect(async_=True, connection_factory=ForumConnection, **self.kwargs)
+        await wait(conn)
+        return conn
+
+    async def getconn(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        while True:
+            if self._idle.empty() and self.opened < self.size:
+                self.opened += 1
+                try:
+                    return await self._connect()
+                except BaseException:
+                    self.opened -= 1
+                    raise
+            conn = await self._idle.get()
+            if conn is not None:
+                return conn
+
+    def putconn(self, conn, close=False):
+        if close or conn.closed:
+            conn.close()
+            self.opened -= 1
+            self._idle.put_nowait(None)  # wakes a waiting request to open a replacement
+            return
+        self._idle.put_nowait(conn)
+
+
+pool = AsyncPool(ASYNC_POOL_SIZE, **DB_SETTINGS)
+replica_pools = [AsyncPool(ASYNC_POOL_SIZE, dsn=dsn) for dsn in REPLICA_DSNS]
+replica_turns = count()
+
+
+def get_pool(replica=False):
+    if replica and replica_pools:
+        return replica_pools[next(replica_turns) % len(replica_pools)]
+    return pool
+
+
+async def fetch(sql, params=None, replica=False):
+    """Rows of `sql`, run as a prepared statement on a pooled asynchronous connection.
+
+    With `replica`, the connection comes from one of the replicas, if any is
+    configured.
+    """
+    conn_pool = get_pool(replica)
+    conn = await conn_pool.getconn()
+    broken = False
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        start = time.monotonic()
+        for query, arguments in statements.steps(conn, sql, params):
+            cur.execute(query, arguments)
+            await wait(conn)
+        metrics.record_query(sql, time.monotonic() - start)
+        return cur.fetchall()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError, asyncio.CancelledError):
+        # a cancelled request leaves its query running on the connection
+        broken = True
+        raise
+    finally:
+        conn_pool.putconn(conn, close=broken)
+
+
+async def fetchone(sql, params=None, replica=False):
+    rows = await fetch(sql, params, replica)
+    return rows[0] if rows else None
+
+
+async def fetch_chunks(sql, params, chunk_size, replica=False):
+    """Asynchronous generator of the rows of `sql`, `chunk_size` rows at a time.
+
+    The rows are read through a cursor declared in an explicit transaction,
+    so memory stays bounded whatever the size of the result. The connection
+    is held until the generator is exhausted, and closed if it is abandoned.
+    """
+    conn_pool = get_pool(replica)
+    conn = await conn_pool.getconn()
+    broken = False
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        seconds = 0
+
+        async def run(query, arguments=None):
+            nonlocal seconds
+            start = time.monotonic()
+            cur.execute(query, arguments)
+            await wait(conn)
+            seconds += time.monotonic() - start
+
+        await run('begin')
+        await run(f'declare chunks no scroll cursor for {sql}', params)
+        while True:
+            await run(f'fetch {int(chunk_size)} from chunks')
+            rows = cur.fetchall()
+            if not rows:
+                break
+            yield rows
+        await run('commit')
+        metrics.record_query(sql, seconds)
+    except BaseException:
+        # the transaction is still open on the connection
+        broken = True
+        raise
+    finally:
+        conn_pool.putconn(conn, close=broken)
@@ -0,0 +1,294 @@
+"""asyncio entry point serving the same /api routes as main.py.
+
+    python3.6 async_main.py
+
+The read endpoints below run natively on the event loop, with their SQL built
+by the same functions in forum.py and executed through async_db, so a single
+process keeps hundreds of them in flight. Every other route is handed to the
+Flask app of main.py in a thread pool, on the blocking connection pool.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from os import environ
+from sys import stderr
+from aiohttp import web
+from flask import abort, json
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags, quote_etag
+import access_log
+import async_db
+import cache
+import forum
+import metrics
+from connect_db import POOL_MAX_SIZE, READ_YOUR_WRITES_COOKIE, reads_own_writes
+from main import app as flask_app
+
+ASYNC_HOST = environ.get('FORUM_ASYNC_HOST', '0.0.0.0')
+ASYNC_PORT = int(environ.get('FORUM_ASYNC_PORT', 5000))
+CACHE_RECONNECT_INTERVAL = 1
+
+routes = web.RouteTableDef()
+
+
+def json_response(status, to_json):
+    return web.Response(status=status, text=json.dumps(to_json), content_type='application/json')
+
+
+def rendered_json_response(status, body):
+    return web.Response(status=status, text=body, content_type='application/json')
+
+
+def not_modified(request, entity_tag):
+    return parse_etags(request.headers.get('If-None-Match')).contains(entity_tag)
+
+
+def tagged(response, entity_tag):
+    response.headers['ETag'] = quote_etag(entity_tag)
+    return response
+
+
+@web.middleware
+async def request_log(request, handler):
+    start = time.monotonic()
+    # Flask sets the read-your-writes cookie on the writes it answers
+    request['replica'] = request.method == 'GET' and \
+        not reads_own_writes(request.remote, request.cookies.get(READ_YOUR_WRITES_COOKIE))
+    try:
+        response = await handler(request)
+    except HTTPException as error:
+        # aborts raised by the forum.py helpers, rendered like main.py does
+        response = json_response(error.code, {'message': str(error)})
+    seconds = time.monotonic() - start
+    if request.match_info.route.name != 'wsgi':
+        access_log.log_request(seconds, request.method, request.path_qs, response.status)
+        metrics.record_request(f'{request.method} {request.match_info.route.resource.canonical}', seconds)
+    return response
+
+
+async def get_user(user_id=None, nickname=None):
+    field, value = ('id', user_id) if user_id is not None else ('nickname', nickname)
+    user = cache.users.get(field, value)
+    if user is not None:
+        return user
+    token = cache.users.token()
+    user = await async_db.fetchone(f'select * from users where {field} = %s;', (value,))
+    cache.users.put(user, token)
+    return user or abort(404, value)
+
+
+async def get_forum(slug_or_id):
+    field = 'id' if str(slug_or_id).isdigit() else 'slug'
+    row = cache.forums.get(field, slug_or_id)
+    if row is not None:
+        return row
+    token = cache.forums.token()
+    row = await async_db.fetchone(f'''select * from forums where {field} = %s;''', (slug_or_id,))
+    cache.forums.put(row, token)
+    return row or abort(404, slug_or_id)
+
+
+async def get_thread(slug_or_id):
+    field = 'id' if slug_or_id.isdigit() else 'slug'
+    thread = cache.threads.get(field, slug_or_id)
+    if thread is None:
+        token = cache.threads.token()
+        thread = await async_db.fetchone(f'''select * from threads where
+                {field} = %(slug_or_id)s''', {'forum_id': None, 'slug_or_id': slug_or_id})
+        cache.threads.put(thread, token)
+    return forum.replace_time_format(thread) if thread is not None else abort(404, slug_or_id)
+
+
+async def fetch_json_array(request, sql, params):
+    return (await async_db.fetchone(forum.json_array_sql(sql), params, replica=request['replica']))['json']
+
+
+async def stream_json_array(request, sql, params):
+    """Response rendering the rows of `sql` as a JSON array, like forum.stream_json_array."""
+    response = web.StreamResponse(status=forum.OK)
+    response.content_type = 'application/json'
+    await response.prepare(request)
+    separator = b'['
+    async for rows in async_db.fetch_chunks(forum.json_rows_sql(sql), params, forum.STREAM_CHUNK_SIZE,
+                                            replica=request['replica']):
+        await response.write(separator + ','.join(row['json'] for row in rows).encode('utf-8'))
+        separator = b','
+    await response.write(b'[]' if separator == b'[' else b']')
+    await response.write_eof()
+    return response
+
+
+@routes.get('/api/forum/{slug}/details')
+async def get_forum_details(request):
+    row = await get_forum(request.match_info['slug'])
+    counts = await async_db.fetchone(forum.forum_counts_sql('%s'), (row['id'],), replica=request['replica'])
+    row = dict(row, **counts)
+    user = await get_user(user_id=row['user_id'])
+    entity_tag = forum.forum_etag(row, user)
+    if not_modified(request, entity_tag):
+        return tagged(web.Response(status=forum.NOT_MODIFIED), entity_tag)
+    return tagged(json_response(forum.OK, forum.get_forum_info(row, user)), entity_tag)
+
+
+@routes.get('/api/forum/{slug}/threads')
+async def get_forum_threads(request):
+    slug = request.match_info['slug']
+    await get_forum(slug)
+    query = request.query
+    sql, params = forum.threads_query(slug, query.get('limit'), query.get('since'), query.get('desc') == 'true',
+                                      as_json=True)
+    return rendered_json_response(forum.OK, await fetch_json_array(request, sql, params))
+
+
+@routes.get('/api/forum/{slug}/users')
+async def get_forum_users(request):
+    row = await get_forum(request.match_info['slug'])
+    query = request.query
+    sql, params = forum.forum_users_query(row['id'], query.get('limit'), query.get('since'), query.get('desc') == 'true')
+    return rendered_json_response(forum.OK, await fetch_json_array(request, sql, params))
+
+
+@routes.get('/api/post/{p_id}/details')
+async def get_post_details(request):
+    post_id = request.match_info['p_id']
+    what_to_show = request.query.get('related')
+    what_to_show = what_to_show.split(',') if what_to_show is not None else None
+    post = await async_db.fetchone(*forum.post_info_query(post_id, what_to_show, thread_as_id=True),
+                                   replica=request['replica'])
+    if post is None:
+        abort(404, post_id)
+    return json_response(forum.OK, forum.post_info_answer(post, what_to_show))
+
+
+@routes.get('/api/service/status')
+async def get_status(request):
+    rows = await async_db.fetch(forum.status_query(approximate=request.query.get('approximate') == 'true'),
+                                replica=request['replica'])
+    return json_response(forum.OK, forum.status_answer(rows))
+
+
+@routes.get('/api/thread/{slug_or_id}/details')
+async def get_thread_details(request):
+    thread = await get_thread(request.match_info['slug_or_id'])
+    entity_tag = forum.thread_etag(thread)
+    if not_modified(request, entity_tag):
+        return tagged(web.Response(status=forum.NOT_MODIFIED), entity_tag)
+    return tagged(json_response(forum.OK, forum.get_thread_info(thread, forum={'slug': thread['forum_slug']},
+                                                                user={'nickname': thread['user_nickname']})),
+                  entity_tag)
+
+
+@routes.get('/api/thread/{slug_or_id}/posts')
+async def get_posts(request):
+    thread = await get_thread(request.match_info['slug_or_id'])
+    query = request.query
+    # the tree index builds its trees with blocking queries, so it is not used here
+    sql, params = forum.posts_query(thread['id'], query.get('limit'), query.get('since'), query.get('sort'),
+                                    query.get('desc') == 'true', as_json=True)
+    if not query.get('limit'):
+        return await stream_json_array(request, sql, params)
+    return rendered_json_response(forum.OK, await fetch_json_array(request, sql, params))
+
+
+@routes.get('/api/user/{nickname}/profile')
+async def get_user_profile(request):
+    user = await get_user(nickname=request.match_info['nickname'])
+    entity_tag = forum.user_etag(user)
+    if not_modified(request, entity_tag):
+        return tagged(web.Response(status=forum.NOT_MODIFIED), entity_tag)
+    return tagged(json_response(forum.OK, forum.get_dict_part(user, ['nickname', 'email', 'fullname', 'about'])),
+                  entity_tag)
+
+
+class WSGIBridge:
+    """aiohttp handler running a WSGI application in a thread pool."""
+
+    def __init__(self, wsgi_app, executor):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+
+    def environ(self, request, body):
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': request.query_string,
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': ASYNC_HOST,
+            'SERVER_PORT': str(ASYNC_PORT),
+            'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+            'REMOTE_ADDR': request.remote or '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scheme,
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    def run(self, environ):
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started['status'], started['headers'], body
+
+    async def __call__(self, request):
+        environ = self.environ(request, await request.read())
+        loop = asyncio.get_event_loop()
+        status, headers, body = await loop.run_in_executor(self.executor, self.run, environ)
+        response = web.Response(status=status, body=body)
+        for name, value in headers:
+            if name.lower() not in ('content-length', 'transfer-encoding'):
+                response.headers.add(name, value)
+        return response
+
+
+async def keep_cache_listening():
+    """Reconnect the cache's listener in a thread whenever it is down, so `poll` never connects on the loop."""
+    loop = asyncio.get_event_loop()
+    while True:
+        if not cache.listener.connected:
+            await loop.run_in_executor(None, cache.listener.connect)
+        await asyncio.sleep(CACHE_RECONNECT_INTERVAL)
+
+
+async def start_cache_listener(app):
+    app['cache_listener'] = asyncio.ensure_future(keep_cache_listening())
+
+
+async def stop_cache_listener(app):
+    app['cache_listener'].cancel()
+
+
+def make_app():
+    # until the listener is connected, lookups bypass the cache
+    cache.listener.connect_on_poll = False
+    app = web.Application(middlewares=[request_log])
+    if cache.enabled:
+        app.on_startup.append(start_cache_listener)
+        app.on_cleanup.append(stop_cache_listener)
+    app.add_routes(routes)
+    bridge = WSGIBridge(flask_app, ThreadPoolExecutor(POOL_MAX_SIZE))
+    app.router.add_route('*', '/{path:.*}', bridge, name='wsgi')
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(make_app(), host=ASYNC_HOST, port=ASYNC_PORT)
@@ -0,0 +1,301 @@
+"""Bulk loader for seeding the forum from NDJSON files.
+
+    python3.6 bulk_load.py --users users.ndjson --forums forums.ndjson \\
+        --threads threads.ndjson --posts posts.ndjson --votes votes.ndjson
+
+Every file holds one JSON object per line, shaped like the body of the API
+request that would create it:
+
+    users    {"nickname", "fullname", "email", "about"}
+    forums   {"slug", "title", "user"}
+    threads  {"id"?, "slug"?, "title", "author", "forum", "message", "created"?}
+    posts    {"id"?, "parent"?, "author", "thread", "message", "created"?, "isEdited"?}
+    votes    {"nickname", "thread", "voice"}
+
+`thread` is a thread id or slug, as in the URLs. Posts that are parents of
+other posts in the same file need an explicit id; posts may also answer
+posts that are already in the database.
+
+The lines are COPYed as they are into temporary tables and everything else,
+including parent_path, root_id, forum_user, the forum post and thread
+counts, thread votes and the /service/status counters, is computed by a few
+set-based statements. The whole load is a single transaction.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+import cache
+from connect_db import connect_DB
+
+DB_INIT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_init.sql')
+CREATE_INDEX_PATTERN = re.compile(r'^create index (\w+) on .*?;', re.MULTILINE | re.IGNORECASE)
+
+# One JSON document per line: quote and delimiter characters that JSON never
+# contains unescaped make COPY take every line verbatim.
+COPY_SQL = r"copy {table} (doc) from stdin with (format csv, quote e'\x01', delimiter e'\x02')"
+
+# Digits address a thread by id, anything else by slug, like the API routes.
+THREAD_JOIN = r'''threads as t on t.id = coalesce(
+                      case when s.doc->>'thread' ~ '^\d+$' then (s.doc->>'thread')::int end,
+                      (select id from threads where slug = (s.doc->>'thread')::citext))'''
+
+
+class LoadError(Exception):
+    pass
+
+
+def db_init_indexes():
+    """Names and create statements of the secondary indexes in db_init.sql."""
+    with open(DB_INIT_PATH) as file:
+        return [(match.group(1), match.group(0)) for match in CREATE_INDEX_PATTERN.finditer(file.read())]
+
+
+def stage(cur, table, path):
+    cur.execute(f'create temp table {table} (line serial, doc jsonb) on commit drop')
+    with open(path, encoding='utf-8') as file:
+        cur.copy_expert(COPY_SQL.format(table=table), file)
+    cur.execute(f'delete from {table} where doc is null')  # blank lines
+    cur.execute(f'select count(*) as count from {table}')
+    return cur.fetchone()[0]
+
+
+def check_missing(cur, what, sql):
+    """Fail the load if `sql` finds a row whose reference does not resolve."""
+    cur.execute(sql + ' limit 1')
+    row = cur.fetchone()
+    if row is not None:
+        raise LoadError(f'{what} not found: {row[0]}')
+
+
+def add_counter(cur, counter, value):
+    if value:
+        cur.execute('''insert into counters (name, shard, value) values (%s, 0, %s)
+                       on conflict (name, shard) do update set value = counters.value + excluded.value''',
+                    (counter, value))
+
+
+def load_users(cur, path):
+    count = stage(cur, 'staged_users', path)
+    cur.execute('''insert into users (nickname, fullname, email, about)
+                   select doc->>'nickname', doc->>'fullname', doc->>'email', doc->>'about'
+                   from staged_users''')
+    add_counter(cur, 'user', count)
+    return count
+
+
+def load_forums(cur, path):
+    count = stage(cur, 'staged_forums', path)
+    check_missing(cur, 'user', '''select s.doc->>'user' from staged_forums as s
+                                  left join users as u on u.nickname = (s.doc->>'user')::citext
+                                  where u.id is null''')
+    cur.execute('''insert into forums (user_id, title, slug)
+                   select u.id, s.doc->>'title', s.doc->>'slug'
+                   from staged_forums as s
+                       join users as u on u.nickname = (s.doc->>'user')::citext''')
+    add_counter(cur, 'forum', count)
+    return count
+
+
+def load_threads(cur, path):
+    count = stage(cur, 'staged_threads', path)
+    check_missing(cur, 'user', '''select s.doc->>'author' from staged_threads as s
+                                  left join users as u on u.nickname = (s.doc->>'author')::citext
+                                  where u.id is null''')
+    check_missing(cur, 'forum', '''select s.doc->>'forum' from staged_threads as s
+                                   left join forums as f on f.slug = (s.doc->>'forum')::citext
+                                   where f.id is null''')
+    advance_sequence(cur, 'threads', 'staged_threads')
+    cur.execute('''with inserted as (
+                       insert into threads (id, user_id, forum_id, title, message, created, slug,
+                                            user_nickname, forum_slug)
+                       select coalesce((s.doc->>'id')::int, nextval('threads_id_seq')), u.id, f.id,
+                           s.doc->>'title', s.doc->>'message', coalesce((s.doc->>'created')::timestamptz, now()),
+                           nullif(s.doc->>'slug', ''), u.nickname, f.slug
+                       from staged_threads as s
+                           join users as u on u.nickname = (s.doc->>'author')::citext
+                           join forums as f on f.slug = (s.doc->>'forum')::citext
+                       returning user_id, forum_id
+                   ), per_forum as (
+                       insert into forum_counters (forum_id, shard, threads)
+                       select forum_id, 0, count(*) from inserted group by forum_id
+                       on conflict (forum_id, shard) do update set threads = forum_counters.threads + excluded.threads
+                   )
+                   insert into forum_user (user_id, forum_id, nickname, fullname, email, about)
+                   select u.id, i.forum_id, u.nickname, u.fullname, u.email, u.about
+                   from (select distinct user_id, forum_id from inserted) as i
+                       join users as u on u.id = i.user_id
+                   on conflict do nothing''')
+    add_counter(cur, 'thread', count)
+    return count
+
+
+def load_posts(cur, path):
+    count = stage(cur, 'staged_posts', path)
+    check_missing(cur, 'user', '''select s.doc->>'author' from staged_posts as s
+                                  left join users as u on u.nickname = (s.doc->>'author')::citext
+                                  where u.id is null''')
+    check_missing(cur, 'thread', f'''select s.doc->>'thread' from staged_posts as s
+                                     left join {THREAD_JOIN}
+                                     where t.id is null''')
+    advance_sequence(cur, 'posts', 'staged_posts')
+    cur.execute(f'''create temp table resolved_posts on commit drop as
+                    select coalesce((s.doc->>'id')::int, nextval('posts_id_seq')) as id,
+                        coalesce((s.doc->>'parent')::int, 0) as parent_id,
+                        u.id as user_id, u.nickname as user_nickname, t.id as thread_id, t.forum_slug,
+                        s.doc->>'message' as message,
+                        coalesce((s.doc->>'created')::timestamptz, now()) as created,
+                        coalesce((s.doc->>'isEdited')::boolean, false) as is_edited
+                    from staged_posts as s
+                        join users as u on u.nickname = (s.doc->>'author')::citext
+                        join {THREAD_JOIN}''')
+    cur.execute('create index on resolved_posts (parent_id)')
+    cur.execute('analyze resolved_posts')
+
+    # Paths grow top-down from the roots and from posts already in the
+    # database. Posts whose parent is missing or in another thread are left
+    # out and reported below.
+    cur.execute('''create temp table post_paths on commit drop as
+                   with recursive tree as (
+                       select r.id, r.thread_id, array[0, r.id]::bigint[] as parent_path, r.id as root_id
+                       from resolved_posts as r
+                       where r.parent_id = 0
+                       union all
+                       select r.id, r.thread_id, p.parent_path || r.id::bigint, p.root_id
+                       from resolved_posts as r
+                           join posts as p on p.id = r.parent_id and p.thread_id = r.thread_id
+                       union all
+                       select r.id, r.thread_id, t.parent_path || r.id::bigint, t.root_id
+                       from tree as t
+                           join resolved_posts as r on r.parent_id = t.id and r.thread_id = t.thread_id
+                   )
+                   select id, parent_path, root_id from tree''')
+    check_missing(cur, 'parent', '''select r.parent_id from resolved_posts as r
+                                    left join post_paths as p on p.id = r.id
+                                    where p.id is null''')
+
+    cur.execute('''insert into posts (id, user_id, thread_id, message, created, is_edited, parent_id,
+                                      parent_path, root_id, forum_slug, user_nickname)
+                   select r.id, r.user_id, r.thread_id, r.message, r.created, r.is_edited, r.parent_id,
+                       p.parent_path, p.root_id, r.forum_slug, r.user_nickname
+                   from resolved_posts as r
+                       join post_paths as p on p.id = r.id
+                   order by r.id''')
+    cur.execute('''insert into forum_counters (forum_id, shard, posts)
+                   select f.id, 0, count(*)
+                   from resolved_posts as r
+                       join forums as f on f.slug = r.forum_slug
+                   group by f.id
+                   on conflict (forum_id, shard) do update set posts = forum_counters.posts + excluded.posts''')
+    cur.execute('''insert into forum_user (user_id, forum_id, nickname, fullname, email, about)
+                   select u.id, f.id, u.nickname, u.fullname, u.email, u.about
+                   from (select distinct user_id, forum_slug from resolved_posts) as r
+                       join users as u on u.id = r.user_id
+                       join forums as f on f.slug = r.forum_slug
+                   on conflict do nothing''')
+    add_counter(cur, 'post', count)
+    return count
+
+
+def load_votes(cur, path):
+    count = stage(cur, 'staged_votes', path)
+    check_missing(cur, 'user', '''select s.doc->>'nickname' from staged_votes as s
+                                  left join users as u on u.nickname = (s.doc->>'nickname')::citext
+                                  where u.id is null''')
+    check_missing(cur, 'thread', f'''select s.doc->>'thread' from staged_votes as s
+                                     left join {THREAD_JOIN}
+                                     where t.id is null''')
+    # The last vote of a user on a thread wins, like repeated API calls.
+    cur.execute(f'''with latest as (
+                        select distinct on (u.id, t.id) u.id as user_id, t.id as thread_id,
+                            (s.doc->>'voice')::smallint as voice
+                        from staged_votes as s
+                            join users as u on u.nickname = (s.doc->>'nickname')::citext
+                            join {THREAD_JOIN}
+                        order by u.id, t.id, s.line desc
+                    ), previous as (
+                        select v.user_id, v.thread_id, v.voice
+                        from votes as v
+                            join latest as l on l.user_id = v.user_id and l.thread_id = v.thread_id
+                    ), voted as (
+                        insert into votes (user_id, thread_id, voice)
+                        select user_id, thread_id, voice from latest
+                        on conflict (user_id, thread_id) do update set voice = excluded.voice
+                    )
+                    update threads as t set votes = t.votes + d.delta, version = t.version + 1
+                    from (select l.thread_id, sum(l.voice - coalesce(p.voice, 0)) as delta
+                          from latest as l
+                              left join previous as p on p.user_id = l.user_id and p.thread_id = l.thread_id
+                          group by l.thread_id) as d
+                    where t.id = d.thread_id and d.delta <> 0''')
+    return count
+
+
+def advance_sequence(cur, table, staged):
+    """Move the id sequence of `table` past the ids given explicitly in `staged`."""
+    cur.execute(f'''select setval('{table}_id_seq', m)
+                    from (select greatest(max(id), (select max((doc->>'id')::int) from {staged})) as m
+                          from {table}) as ids
+                    where m is not null''')
+
+
+def bulk_load(paths, rebuild_indexes=False, skip_triggers=False, log=sys.stderr):
+    """Load the NDJSON files in `paths` ({'users': path, ...}) in one transaction."""
+    loaders = [('users', load_users), ('forums', load_forums), ('threads', load_threads),
+               ('posts', load_posts), ('votes', load_votes)]
+    conn = connect_DB()
+    conn.autocommit = False
+    try:
+        with conn.cursor() as cur:
+            if skip_triggers:
+                # foreign keys and the cache triggers are row triggers too;
+                # every reference is resolved by the loader instead
+                cur.execute('set local session_replication_role = replica')
+            indexes = db_init_indexes() if rebuild_indexes else []
+            for name, _ in indexes:
+                cur.execute(f'drop index if exists {name}')
+
+            for name, load in loaders:
+                if paths.get(name):
+                    start = time.monotonic()
+                    count = load(cur, paths[name])
+                    print(f'{name}: {count} rows in {time.monotonic() - start:.1f}s', file=log)
+
+            for name, create_index in indexes:
+                start = time.monotonic()
+                cur.execute(create_index)
+                print(f'index {name} in {time.monotonic() - start:.1f}s', file=log)
+            for table in ('users', 'forums', 'threads', 'posts', 'votes', 'forum_user', 'forum_counters'):
+                cur.execute(f'analyze {table}')
+            for table in list(cache.entity_caches) + ['posts']:
+                cur.execute('select pg_notify(%s, %s)', (cache.CACHE_CHANNEL, f'{table}:*'))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load NDJSON files into the forum database with COPY.')
+    for name in ('users', 'forums', 'threads', 'posts', 'votes'):
+        parser.add_argument(f'--{name}', metavar='PATH', help=f'NDJSON file of {name}')
+    parser.add_argument('--rebuild-indexes', action='store_true',
+                        help='drop the db_init.sql indexes before the load and create them after it')
+    parser.add_argument('--skip-triggers', action='store_true',
+                        help='run with session_replication_role = replica (needs a superuser)')
+    args = parser.parse_args(argv)
+
+    paths = {name: getattr(args, name) for name in ('users', 'forums', 'threads', 'posts', 'votes')}
+    if not any(paths.values()):
+        parser.error('nothing to load')
+    try:
+        bulk_load(paths, args.rebuild_indexes, args.skip_triggers)
+    except LoadError as error:
+        parser.exit(1, f'{error}\n')
+
+
+if __name__ == '__main__':
+    main()
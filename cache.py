@@ -0,0 +1,287 @@
+"""In-process LRU+TTL cache of users, forums and threads.
+
+Every worker keeps its own cache. Writes made by this worker invalidate
+entries directly; writes made by other workers arrive as notifications on
+the `forum_cache` channel, which the triggers in db_init.sql send whenever a
+row of a cached table is updated or deleted. If the listening connection is
+lost the cache is emptied and bypassed until it comes back.
+"""
+import threading
+import time
+from collections import OrderedDict
+from os import environ, getpid
+import psycopg2
+import psycopg2.extensions
+from connect_db import DB_SETTINGS
+
+CACHE_SIZE = int(environ.get('FORUM_CACHE_SIZE', 10000))
+CACHE_TTL = float(environ.get('FORUM_CACHE_TTL', 60))
+CACHE_CHANNEL = 'forum_cache'
+
+
+class LRUCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[1] if item is not None else None
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class EntityCache:
+    """Rows of one table, addressable by id and by their unique text fields.
+
+    Text keys are compared case-insensitively, like the citext columns they
+    mirror, and resolve to the id of the row they belong to.
+    """
+
+    def __init__(self, table, alias_fields, maxsize, ttl):
+        self.table = table
+        self.alias_fields = alias_fields
+        self._entries = LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(field, value):
+        if field == 'id':
+            return ('id', int(value))
+        return (field, str(value).lower())
+
+    def get(self, field, value):
+        if not listener.poll():
+            return None
+        with self._lock:
+            key = self._key(field, value)
+            if field != 'id':
+                entity_id = self._entries.get(key)
+                if entity_id is None:
+                    return None
+                key = ('id', entity_id)
+            row = self._entries.get(key)
+            return dict(row) if row is not None else None
+
+    def token(self):
+        """Generation to pass to `put` for a row about to be read from the database."""
+        listener.poll()
+        return self.generation
+
+    def put(self, row, token):
+        """Cache `row` unless an invalidation arrived since `token` was taken."""
+        if row is None or not listener.poll():
+            return
+        with self._lock:
+            if token != self.generation:
+                return
+            self._entries.set(('id', row['id']), dict(row))
+            for field in self.alias_fields:
+                if row.get(field):
+                    self._entries.set(self._key(field, row[field]), row['id'])
+
+    def invalidate(self, entity_id):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            row = self._entries.pop(('id', int(entity_id)))
+            if row is not None:
+                for field in self.alias_fields:
+                    if row.get(field):
+                        self._entries.pop(self._key(field, row[field]))
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self._entries.hits,
+            'misses': self._entries.misses,
+            'evictions': self._entries.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class InvalidationListener:
+    """LISTEN connection delivering other workers' invalidations.
+
+    `poll` only reads what is already buffered on the socket, so it does not
+    cost a round trip to the server.
+    """
+
+    def __init__(self, channel, **kwargs):
+        self.channel = channel
+        self.kwargs = kwargs
+        # an event loop cannot afford a blocking connect in `poll`; it
+        # turns this off and calls `connect` from a thread instead
+        self.connect_on_poll = True
+        self._conn = None
+        self._process_id = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.kwargs)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f'listen {self.channel}')
+        return conn
+
+    def _ensure_process(self):
+        if self._process_id != getpid():
+            # the parent's connection and lock are not ours to use
+            self._conn = None
+            self._lock = threading.Lock()
+            self._process_id = getpid()
+
+    @property
+    def connected(self):
+        return self._process_id == getpid() and self._conn is not None and not self._conn.closed
+
+    def connect(self):
+        """Open the listening connection unless it is open; False if that failed.
+
+        The connection is opened outside the lock, so `poll` is never stuck
+        behind a slow connect.
+        """
+        if not enabled:
+            return False
+        self._ensure_process()
+        if self.connected:
+            return True
+        try:
+            conn = self._connect()
+        except psycopg2.Error:
+            return False
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                self._conn, conn = conn, None
+                clear()  # anything could have changed while disconnected
+        if conn is not None:
+            conn.close()  # another thread connected first
+        return True
+
+    def poll(self):
+        """Apply pending invalidations; False if the cache cannot be trusted."""
+        if not enabled:
+            return False
+        self._ensure_process()
+        # without connect_on_poll the caller may be an event loop, which must not wait
+        if not self._lock.acquire(blocking=self.connect_on_poll):
+            return False
+        try:
+            if self._conn is None or self._conn.closed:
+                if not self.connect_on_poll:
+                    return False
+                self._conn = self._connect()
+                clear()  # anything could have changed while disconnected
+            self._conn.poll()
+        except psycopg2.Error:
+            self._conn = None
+            clear()
+            return False
+        else:
+            notifies = list(self._conn.notifies)
+            del self._conn.notifies[:]
+        finally:
+            self._lock.release()
+        for notify in notifies:
+            apply_notification(notify.payload)
+        return True
+
+
+users = EntityCache('users', ('nickname',), CACHE_SIZE, CACHE_TTL)
+forums = EntityCache('forums', ('slug',), CACHE_SIZE, CACHE_TTL)
+threads = EntityCache('threads', ('slug',), CACHE_SIZE, CACHE_TTL)
+entity_caches = {cache.table: cache for cache in (users, forums, threads)}
+
+enabled = CACHE_SIZE > 0
+listener = InvalidationListener(CACHE_CHANNEL, **DB_SETTINGS)
+
+
+notification_handlers = {}
+clear_callbacks = []
+reset_callbacks = []
+
+
+def apply_notification(payload):
+    """Handle a `<table>:<id>` payload, `<table>:*` after a bulk load, or `*`
+    after the database was cleared."""
+    if payload == '*':
+        reset()
+        return
+    table, _, entity_id = payload.partition(':')
+    if table in notification_handlers:
+        notification_handlers[table](entity_id)
+        return
+    if table not in entity_caches or not entity_id:
+        return
+    if entity_id == '*':
+        entity_caches[table].clear()
+    else:
+        entity_caches[table].invalidate(entity_id)
+
+
+def clear():
+    for cache in entity_caches.values():
+        cache.clear()
+    for callback in clear_callbacks:
+        callback()
+
+
+def on_notification(prefix, handler):
+    """Pass the rest of every `<prefix>:...` payload to `handler`."""
+    notification_handlers[prefix] = handler
+    return handler
+
+
+def on_clear(callback):
+    """Call `callback` whenever the cache is emptied, including when it stops being trustworthy."""
+    clear_callbacks.append(callback)
+    return callback
+
+
+def on_reset(callback):
+    """Call `callback` whenever the database is cleared, in this or another worker."""
+    reset_callbacks.append(callback)
+    return callback
+
+
+def reset():
+    clear()
+    for callback in reset_callbacks:
+        callback()
+
+
+def stats():
+    return {table: cache.stats() for table, cache in entity_caches.items()}
@@ -1,11 +1,238 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 import sys
+import threading
+import time
+from itertools import count
+from os import environ, getpid
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+import metrics
+
+DB_SETTINGS = {
+    'host': environ.get('FORUM_DB_HOST', 'localhost'),
+    'database': environ.get('FORUM_DB_NAME', 'forum'),
+    'user': environ.get('FORUM_DB_USER', 'admin'),
+    'password': environ.get('FORUM_DB_PASSWORD', 'admin'),
+}
+
+POOL_MIN_SIZE = int(environ.get('FORUM_POOL_MIN_SIZE', 1))
+POOL_MAX_SIZE = int(environ.get('FORUM_POOL_MAX_SIZE', 10))
+POOL_TIMEOUT = float(environ.get('FORUM_POOL_TIMEOUT', 5))
+POOL_CHECK_ON_BORROW = environ.get('FORUM_POOL_CHECK_ON_BORROW', 'false') == 'true'
+POOL_CHECK_IDLE_AFTER = float(environ.get('FORUM_POOL_CHECK_IDLE_AFTER', 30))
+
+# Comma-separated libpq connection strings of read replicas, e.g.
+# 'host=replica1 dbname=forum user=admin password=admin'.
+REPLICA_DSNS = [dsn.strip() for dsn in environ.get('FORUM_REPLICA_DSNS', '').split(',') if dsn.strip()]
+READ_YOUR_WRITES_WINDOW = float(environ.get('FORUM_READ_YOUR_WRITES_WINDOW', 2))
+READ_YOUR_WRITES_COOKIE = 'forum_last_write'
+
+
+class ForumConnection(psycopg2.extensions.connection):
+    """Connection that remembers which named statements were prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.returned_at = None
+
 
 def connect_DB():
     try:
-        connection = psycopg2.connect(host='localhost', database='forum', user='admin', password='admin')
+        connection = psycopg2.connect(**DB_SETTINGS)
         connection.autocommit = True
     except Exception as error:
         print(error)
 
     return connection
+
+
+class ProcessSafePoolManager:
+    """Connection pool that rebuilds itself in every forked worker.
+
+    Connections inherited from the parent process are dropped without being
+    closed, because closing them would terminate the parent's sessions.
+
+    A borrowed connection is always checked for what libpq already knows,
+    which costs no round trip. It is probed with `select 1` only with
+    `check_on_borrow`, or after it sat in the pool for `check_idle_after`
+    seconds, long enough for the server or a proxy to have dropped it.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=None, check_on_borrow=False, check_idle_after=None, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_on_borrow = check_on_borrow
+        self.check_idle_after = check_idle_after
+        self.kwargs = kwargs
+        self.last_seen_process_id = None
+        self._lock = threading.Lock()
+        self._lock_process_id = getpid()
+        self._pool = None
+        self._slots = None
+
+    def _init(self):
+        self._pool = ThreadedConnectionPool(self.minconn, self.maxconn, **self.kwargs)
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self.last_seen_process_id = getpid()
+
+    def _ensure_pool(self):
+        current_pid = getpid()
+        if self.last_seen_process_id != current_pid:
+            if self._lock_process_id != current_pid:
+                # the parent may have forked while holding the lock
+                self._lock = threading.Lock()
+                self._lock_process_id = current_pid
+            with self._lock:
+                if self.last_seen_process_id != current_pid:
+                    self._init()
+
+    def _is_healthy(self, conn):
+        if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        returned_at = getattr(conn, 'returned_at', None)
+        idle_too_long = self.check_idle_after is not None and returned_at is not None and \
+            time.monotonic() - returned_at > self.check_idle_after
+        if not self.check_on_borrow and not idle_too_long:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('select 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        self._ensure_pool()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError(f'connection pool exhausted after waiting {self.timeout}s')
+        try:
+            conn = self._pool.getconn()
+            while not self._is_healthy(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+            conn.autocommit = False
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        if self.last_seen_process_id != getpid():
+            return  # connection belongs to a pool of the parent process
+        try:
+            if not close and not conn.closed and \
+                    conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            close = True
+        if hasattr(conn, 'returned_at'):
+            conn.returned_at = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=close or conn.closed)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        if self._pool is not None and self.last_seen_process_id == getpid():
+            self._pool.closeall()
+
+
+pool = ProcessSafePoolManager(POOL_MIN_SIZE, POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                              check_on_borrow=POOL_CHECK_ON_BORROW, check_idle_after=POOL_CHECK_IDLE_AFTER,
+                              connection_factory=ForumConnection, **DB_SETTINGS)
+
+replica_pools = [ProcessSafePoolManager(POOL_MIN_SIZE, POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                                        check_on_borrow=POOL_CHECK_ON_BORROW, check_idle_after=POOL_CHECK_IDLE_AFTER,
+                                        connection_factory=ForumConnection, dsn=dsn)
+                 for dsn in REPLICA_DSNS]
+replica_turns = count()
+
+_checkout = threading.local()
+_routing = threading.local()
+_last_writes = {}
+
+
+def route_reads_to_replicas(enabled):
+    """Send the transactions this thread starts from now on to a replica, if any is configured."""
+    _routing.replica = enabled and bool(replica_pools)
+
+
+def record_write(client):
+    """Remember that `client` wrote just now; returns the value for READ_YOUR_WRITES_COOKIE."""
+    now = time.time()
+    if len(_last_writes) > 10000:
+        for key, written in list(_last_writes.items()):
+            if now - written > READ_YOUR_WRITES_WINDOW:
+                del _last_writes[key]
+    _last_writes[client] = now
+    return repr(now)
+
+
+def reads_own_writes(client, cookie=None):
+    """Whether `client` wrote recently enough that it must keep reading from the primary.
+
+    The cookie covers writes answered by other workers; the address covers
+    clients that do not keep cookies but came back to this one.
+    """
+    written = _last_writes.get(client, 0)
+    try:
+        written = max(written, float(cookie or 0))
+    except ValueError:
+        pass
+    return time.time() - written < READ_YOUR_WRITES_WINDOW
+
+
+@contextmanager
+def get_DB_cursor(name=None, primary=False):
+    """Cursor on a pooled connection, scoped to a single transaction.
+
+    Nested calls on the same thread reuse the connection checked out by the
+    outermost call, so helpers called while a cursor is open share its
+    transaction. Only the outermost call commits, rolls back and returns the
+    connection to the pool. A `name` makes it a server-side cursor.
+
+    The outermost call runs on a replica while reads are routed to replicas,
+    unless `primary` asks for data that must not lag behind, like rows that
+    are about to be cached. A nested call cannot switch connections, so
+    asking for the primary inside a replica checkout raises RuntimeError.
+    """
+    if getattr(_checkout, 'pid', None) != getpid():
+        _checkout.pid = getpid()
+        _checkout.conn = None
+
+    is_outermost = _checkout.conn is None
+    if is_outermost:
+        if getattr(_routing, 'replica', False) and not primary:
+            _checkout.pool = replica_pools[next(replica_turns) % len(replica_pools)]
+        else:
+            _checkout.pool = pool
+        _checkout.conn = _checkout.pool.getconn()
+    elif primary and _checkout.pool is not pool:
+        raise RuntimeError('get_DB_cursor(primary=True) nested in a cursor on a replica')
+    conn = _checkout.conn
+    conn_pool = _checkout.pool
+
+    cur = conn.cursor(name, cursor_factory=metrics.TimedCursor)
+    broken = False
+    try:
+        yield cur
+    except Exception:
+        if is_outermost:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        raise
+    else:
+        if is_outermost:
+            conn.commit()
+    finally:
+        cur.close()
+        if is_outermost:
+            _checkout.conn = None
+            conn_pool.putconn(conn, close=broken)
@@ -5,14 +5,18 @@ drop index if exists threads_slug;
 drop index if exists threads_user_id;
 drop index if exists threads_created;
 drop index if exists threads_forum_slug;
+drop index if exists threads_forum_slug_created;
 drop index if exists posts_user_id;
 drop index if exists posts_thread_id;
 drop index if exists posts_parent_path;
 drop index if exists posts_parent_path_gin;
 drop index if exists posts_parent_path_2;
+drop index if exists posts_thread_root_path;
+drop index if exists posts_thread_roots;
 drop index if exists votes_thread_id;
 drop index if exists forum_user_user_id;
 drop index if exists forum_user_forum_id;
+drop index if exists forum_user_forum_nickname;
 
 drop table if exists users cascade;
 drop table if exists forums cascade;
@@ -20,15 +24,19 @@ drop table if exists votes cascade;
 drop table if exists threads cascade;
 drop table if exists posts cascade;
 drop table if exists forum_user cascade;
+drop table if exists counters cascade;
+drop table if exists forum_counters cascade;
 drop trigger if exists set_parent_path on posts;
 drop function if exists create_parent_path();
+drop function if exists notify_cache();
 
 create table users (
     id serial primary key,
     nickname citext collate pg_catalog.ucs_basic unique not null,
     email citext unique,
     about text,
-    fullname text
+    fullname text,
+    version int not null default 0
 );
 
 create index users_nickname on users(nickname);
@@ -37,9 +45,7 @@ create table forums (
     id serial primary key,
     user_id int references users(id) on delete cascade,
     title text not null,
-    slug citext unique not null,
-    posts_count int default 0,
-    threads_count int default 0
+    slug citext unique not null
 );
 
 create index forums_slug on forums(slug);
@@ -56,13 +62,13 @@ create table threads (
     slug citext unique,
     votes int default 0,
     user_nickname citext collate pg_catalog.ucs_basic not null,
-    forum_slug citext not null
+    forum_slug citext not null,
+    version int not null default 0
 );
 
 create index threads_slug on threads(slug);
 create index threads_user_id on threads(user_id);
-create index threads_created on threads(created);
-create index threads_forum_slug on threads(forum_slug);
+create index threads_forum_slug_created on threads(forum_slug, created);
 
 
 create table posts (
@@ -75,6 +81,7 @@ create table posts (
     is_edited boolean default false,
     parent_id int default 0,
     parent_path bigint [],
+    root_id int,
     forum_slug citext not null,
     user_nickname citext collate pg_catalog.ucs_basic not null
 );
@@ -83,7 +90,8 @@ create index posts_user_id on posts(user_id, id);
 create index posts_thread_id on posts(thread_id, id);
 create index posts_parent_path on posts(parent_path);
 create index posts_parent_path_gin on posts using gin (parent_path);
-create index posts_parent_path_2 on posts ((parent_path[2]));
+create index posts_thread_root_path on posts(thread_id, root_id, parent_path);
+create index posts_thread_roots on posts(thread_id, id) where parent_id = 0;
 
 
 create table votes (
@@ -97,16 +105,40 @@ create table votes (
 create index votes_thread_id on votes(thread_id);
 
 
+-- Participants of a forum, with a copy of their profile so that a page of
+-- /forum/<slug>/users is a range scan of forum_user_forum_nickname.
 create table forum_user (
     id serial primary key,
     user_id int references users(id) on delete cascade,
     forum_id int references forums(id) on delete cascade,
+    nickname citext collate pg_catalog.ucs_basic not null,
+    fullname text,
+    email citext,
+    about text,
     unique (user_id, forum_id)
 );
 
 
 create index forum_user_user_id on forum_user(user_id);
-create index forum_user_forum_id on forum_user(forum_id);
+create index forum_user_forum_nickname on forum_user(forum_id, nickname);
+
+-- Sharded row counts for /service/status, see count_rows_sql in forum.py.
+create table counters (
+    name text,
+    shard smallint,
+    value bigint not null default 0,
+    primary key (name, shard)
+);
+
+-- Sharded posts_count and threads_count of every forum, see forum_counters_sql
+-- in forum.py.
+create table forum_counters (
+    forum_id int references forums(id) on delete cascade,
+    shard smallint,
+    posts bigint not null default 0,
+    threads bigint not null default 0,
+    primary key (forum_id, shard)
+);
 
 -- create function update_forum_user() returns trigger as
 -- $$
@@ -120,22 +152,42 @@ create index forum_user_forum_id on forum_user(forum_id);
 --     for each row execute procedure update_forum_user();
 
 
+-- add_posts computes parent_path and root_id before the row is written; the
+-- trigger only fills them in for inserts that leave them empty, so every post
+-- is written once.
 create function create_parent_path() returns trigger as
 $$
-    declare
-        old_path int[];
-        new_path int[];
     begin
-        if new.parent_id = 0 then
-            update posts set parent_path = array [0, new.id] where id = new.id;
-        else
-            select parent_path into old_path from posts where id = new.parent_id;
-            new_path := old_path || new.id;
-            update posts set parent_path = new_path where id = new.id;
+        if new.parent_path is null or new.root_id is null then
+            if new.parent_id = 0 then
+                new.parent_path := array [0, new.id];
+                new.root_id := new.id;
+            else
+                select parent_path || new.id::bigint, root_id into new.parent_path, new.root_id
+                    from posts where thread_id = new.thread_id and id = new.parent_id;
+            end if;
         end if;
         return new;
     end;
 $$ language plpgsql;
 
-create trigger set_parent_path after insert on posts
+create trigger set_parent_path before insert on posts
     for each row execute procedure create_parent_path();
+
+
+-- cache.py keeps users, forums and threads in memory in every worker; tell
+-- the other workers which rows went stale.
+create function notify_cache() returns trigger as
+$$
+    begin
+        perform pg_notify('forum_cache', tg_table_name || ':' || old.id);
+        return null;
+    end;
+$$ language plpgsql;
+
+create trigger users_notify_cache after update or delete on users
+    for each row execute procedure notify_cache();
+create trigger forums_notify_cache after update or delete on forums
+    for each row execute procedure notify_cache();
+create trigger threads_notify_cache after update or delete on threads
+    for each row execute procedure notify_cache();
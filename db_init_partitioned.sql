@@ -0,0 +1,53 @@
+-- Optional schema for Postgres 11 and later, run after db_init.sql: posts
+-- becomes a table partitioned by hash of thread_id. Every query of a thread's
+-- posts names its thread_id, so the planner prunes it to a single partition
+-- whose indexes grow with that partition only.
+--
+-- The number of partitions is read from the forum.posts_partitions setting,
+-- 16 by default:
+--     PGOPTIONS='-c forum.posts_partitions=64' psql forum -f db_init_partitioned.sql
+-- FORUM_POSTS_PARTITIONS makes init_schema in forum.py run this file too.
+
+drop table if exists posts cascade;
+
+-- The primary key of a partitioned table must include the partition key; with
+-- id first it still serves the lookups of a post by id alone, which probe the
+-- key of every partition.
+create table posts (
+    id serial,
+    user_id int references users(id) on delete cascade,
+    thread_id int references threads(id) on delete cascade,
+    message text,
+    created timestamptz default now(),
+    is_edited boolean default false,
+    parent_id int default 0,
+    parent_path bigint [],
+    root_id int,
+    forum_slug citext not null,
+    user_nickname citext collate pg_catalog.ucs_basic not null,
+    primary key (id, thread_id)
+) partition by hash (thread_id);
+
+-- Row triggers cannot be defined on a partitioned table before Postgres 13,
+-- so every partition gets its own set_parent_path.
+do $$
+    declare
+        partitions int := coalesce(nullif(current_setting('forum.posts_partitions', true), ''), '16')::int;
+    begin
+        for remainder in 0 .. partitions - 1 loop
+            execute format('create table posts_%s partition of posts for values with (modulus %s, remainder %s)',
+                           remainder, partitions, remainder);
+            execute format('create trigger set_parent_path before insert on posts_%s
+                                for each row execute procedure create_parent_path()', remainder);
+        end loop;
+    end;
+$$;
+
+-- Same names and definitions as in db_init.sql, so that bulk_load.py
+-- --rebuild-indexes still applies; each is created on every partition.
+create index posts_user_id on posts(user_id, id);
+create index posts_thread_id on posts(thread_id, id);
+create index posts_parent_path on posts(parent_path);
+create index posts_parent_path_gin on posts using gin (parent_path);
+create index posts_thread_root_path on posts(thread_id, root_id, parent_path);
+create index posts_thread_roots on posts(thread_id, id) where parent_id = 0;
@@ -1,103 +1,192 @@
 from sys import stderr
-from os import getpid
+from os import environ, getpid
+from threading import get_ident
+from itertools import count
+import hashlib
+import re
+import time
 import pytz
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from contextlib import contextmanager
 import numbers
 from flask import Blueprint, request, Response, json, abort
-from connect_db import connect_DB
+from connect_db import (get_DB_cursor, route_reads_to_replicas, record_write, reads_own_writes, replica_pools,
+                        READ_YOUR_WRITES_COOKIE, READ_YOUR_WRITES_WINDOW)
+import cache
+import metrics
+import statements
+import tree_index
+import votes
 import psycopg2
 import psycopg2.extras
-from psycopg2.pool import ThreadedConnectionPool
 
 forum_blueprint = Blueprint('forum', __name__)
 
 CONFLICT = 409
 CREATED = 201
+NOT_MODIFIED = 304
 OK = 200
 
-# class ProcessSafePoolManager:
-#     def __init__(self, *args, **kwargs):
-#         self.last_seen_process_id = getpid()
-#         self.args = args
-#         self.kwargs = kwargs
-#         self._init()
+COUNTER_SHARDS = 16
+INSERT_OR_SELECT_ATTEMPTS = 3
+POSTS_PARTITIONS = int(environ.get('FORUM_POSTS_PARTITIONS', 0))
+STREAM_CHUNK_SIZE = 1000
 
+TIME_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?'
+                          r'(Z|[+-]\d{2}(?::?\d{2})?)?$')
 
-#     def _init(self):
-#         self._pool = ThreadedConnectionPool(*self.args, **self.kwargs)
+stream_ids = count()
 
+def make_response(status, to_json):
+    start = time.monotonic()
+    body = json.dumps(to_json)
+    metrics.record_serialization(time.monotonic() - start)
+    return Response(
+        response=body,
+        status=status,
+        mimetype="application/json"
+    )
 
-#     def getconn(self):
-#         current_pid = getpid()
-#         if not current_pid == self.last_seen_process_id:
-#             self._init()
-#             self.last_seen_process_id = current_pid
-#         return self._pool.getconn()
 
+def conditional_response(entity_tag, build):
+    """304 when If-None-Match has `entity_tag`, else the response of `build()`; both carry the ETag.
 
-#     def putconn(self, conn):
-#         return self._pool.putconn(conn)
+    Entity tags come from versions that every write of the entity changes, so
+    an unchanged entity is answered without building or serializing its body.
+    """
+    if request.if_none_match.contains(entity_tag):
+        response = Response(status=NOT_MODIFIED)
+    else:
+        response = build()
+    response.set_etag(entity_tag)
+    return response
 
-# pool = ProcessSafePoolManager(1, 10, host='localhost', database='postgres', user='postgres', password='ident')
 
-conn = connect_DB()  # get from pool
-@contextmanager
-def get_DB_cursor():
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    try:
-        # yield conn
-        yield cur
-    except Exception:
-        conn.rollback()
-        raise
-    else:
-        conn.commit()
-    finally:
-        cur.close()
-        # conn.close()  # return to pool
-
-# @contextmanager
-# def get_DB_cursor():
-#     try:
-#         conn = pool.getconn()
-#         with conn:
-#             with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-#                yield cur
-#     except:
-#         # conn.rollback()
-#         raise
-#     finally:
-#         pool.putconn(conn)
+def body_digest(*values):
+    """Short digest of the values a response body is built from.
 
+    Ids, versions and counts start over after /service/clear, so on their own
+    they would give a recreated entity the tag of the one it replaced.
+    """
+    return hashlib.blake2b('\x1f'.join(map(str, values)).encode('utf-8'), digest_size=6).hexdigest()
 
-def make_response(status, to_json):
+
+def user_etag(user):
+    digest = body_digest(user['nickname'], user['email'], user['fullname'], user['about'])
+    return f'u{user["id"]}.{user["version"]}.{digest}'
+
+
+def thread_etag(thread):
+    digest = body_digest(thread['title'], thread['slug'], thread['message'], thread['created'], thread['votes'],
+                         thread['user_nickname'], thread['forum_slug'])
+    return f't{thread["id"]}.{thread["version"]}.{digest}'
+
+
+def forum_etag(forum, user):
+    """Tag of a forum with its counts: they only grow, and nothing else in its details changes."""
+    digest = body_digest(forum['slug'], forum['title'], user['nickname'])
+    return f'f{forum["id"]}.{forum["posts_count"]}.{forum["threads_count"]}.{digest}'
+
+
+@forum_blueprint.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+
+@forum_blueprint.before_request
+def route_reads():
+    # set on every request, so a response streamed after the request ended
+    # still reads where the request did
+    route_reads_to_replicas(request.method == 'GET' and
+                            not reads_own_writes(request.remote_addr, request.cookies.get(READ_YOUR_WRITES_COOKIE)))
+
+
+@forum_blueprint.after_request
+def remember_writes(response):
+    if replica_pools and request.method != 'GET':
+        response.set_cookie(READ_YOUR_WRITES_COOKIE, record_write(request.remote_addr),
+                            max_age=READ_YOUR_WRITES_WINDOW)
+    return response
+
+
+@forum_blueprint.after_request
+def finish_request_metrics(response):
+    rule = request.url_rule.rule if request.url_rule is not None else request.path
+    metrics.finish_request(f'{request.method} {rule}')
+    return response
+
+
+def make_json_response(status, body):
+    """Response for a body that was already rendered to JSON, e.g. by `json_array_sql`."""
     return Response(
-        response=json.dumps(to_json),
+        response=body,
         status=status,
         mimetype="application/json"
     )
 
 
+def json_array_sql(sql):
+    """Wrap a query so Postgres renders its rows as a single JSON array in column `json`."""
+    return f'''select coalesce(json_agg(rows), '[]')::text as json from ({sql}) as rows'''
+
+
+def json_rows_sql(sql):
+    """Wrap a query so Postgres renders each of its rows as JSON in column `json`."""
+    return f'select row_to_json(rows)::text as json from ({sql}) as rows'
+
+
+def stream_json_array(sql, params):
+    """Generator rendering the rows of `sql` as a JSON array, STREAM_CHUNK_SIZE rows at a time.
+
+    Rows are read through a server-side cursor, so memory stays bounded
+    whatever the size of the result. The pooled connection is held until the
+    generator is exhausted or closed.
+    """
+    with get_DB_cursor(name=f'stream_{next(stream_ids)}') as cur:
+        cur.execute(json_rows_sql(sql), params)
+        yield '['
+        separator = ''
+        while True:
+            rows = cur.fetchmany(STREAM_CHUNK_SIZE)
+            if not rows:
+                break
+            yield separator + ','.join(row['json'] for row in rows)
+            separator = ','
+        yield ']'
+
+
+def created_sql(column, as_json=False):
+    """Select-list entry for a timestamp, formatted like `format_time` when rendering JSON in Postgres."""
+    if as_json:
+        return f'''to_char({column} at time zone 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.MS"Z"') as created'''
+    return column
+
+
 def get_user_or_404(user_id=None, email=None, nickname=None, abort404=True):
-    with get_DB_cursor() as cur:
+    if email is None and (user_id is not None or nickname is not None):
+        user = cache.users.get('id', user_id) if user_id is not None else cache.users.get('nickname', nickname)
+        if user is not None:
+            return user
+    token = cache.users.token()
+    with get_DB_cursor(primary=True) as cur:
         if user_id is not None:
             argument = user_id
             sql = 'select * from users where id = %s;'
-            cur.execute(sql, (user_id,))
+            statements.execute(cur, sql, (user_id,))
             user = cur.fetchone()
         elif nickname is not None:
             argument = nickname
             sql = f'''select * from users where nickname = %(nickname)s {'or email = %(email)s' if email else ''}'''
-            cur.execute(sql, {'nickname': nickname, 'email': email})
+            statements.execute(cur, sql, {'nickname': nickname, 'email': email})
             user = cur.fetchone()
         elif email is not None:
             argument = email
             sql = f'''select * from users where email = %s'''
-            cur.execute(sql, (email,))
+            statements.execute(cur, sql, (email,))
             user = cur.fetchone()
         else: 
             raise Exception('No argument!')
+        cache.users.put(user, token)
         return (user or abort(404, argument)) if abort404 else user
 
 
@@ -105,10 +194,16 @@ def get_forum_or_404(slug_or_id=None, abort404=True):
     is_number = lambda x: x.isdigit()
 
     if slug_or_id is not None:
-        with get_DB_cursor() as cur:
-            sql = f'''select * from forums where {'id' if is_number(str(slug_or_id)) else 'slug'} = %s;'''
-            cur.execute(sql, (slug_or_id,))
+        field = 'id' if is_number(str(slug_or_id)) else 'slug'
+        forum = cache.forums.get(field, slug_or_id)
+        if forum is not None:
+            return forum
+        token = cache.forums.token()
+        with get_DB_cursor(primary=True) as cur:
+            sql = f'''select * from forums where {field} = %s;'''
+            statements.execute(cur, sql, (slug_or_id,))
             forum = cur.fetchone()
+            cache.forums.put(forum, token)
             return (forum or abort(404, slug_or_id)) if abort404 else forum
     raise Exception('No argument!')
 
@@ -117,7 +212,7 @@ def get_post_or_404(post_id=None):
     if post_id is not None:
         with get_DB_cursor() as cur:
             sql = 'select * from posts where id = %s;'
-            cur.execute(sql, (post_id,))
+            statements.execute(cur, sql, (post_id,))
             post = cur.fetchone()
             return post or abort(404, post_id)
     raise Exception('No argument!')
@@ -126,80 +221,209 @@ def get_post_or_404(post_id=None):
 def get_thread_or_404(forum_id=None, slug_or_id=None, abort404=True):
     if slug_or_id is not None:
         is_number = lambda x: x.isdigit()
+        field = 'id' if is_number(slug_or_id) else 'slug'
 
-        with get_DB_cursor() as cur:
+        thread = cache.threads.get(field, slug_or_id)
+        if thread is not None:
+            return replace_time_format(thread)
+        token = cache.threads.token()
+        with get_DB_cursor(primary=True) as cur:
             sql = f'''select * from threads where
-                {'id' if is_number(slug_or_id) else 'slug'} = %(slug_or_id)s'''
-            cur.execute(sql, {'forum_id': forum_id, 'slug_or_id': slug_or_id})
+                {field} = %(slug_or_id)s'''
+            statements.execute(cur, sql, {'forum_id': forum_id, 'slug_or_id': slug_or_id})
             thread = cur.fetchone()
             if thread is not None:
+                cache.threads.put(thread, token)
                 thread = replace_time_format(thread)
             return (thread or abort(404, slug_or_id)) if abort404 else thread
     raise Exception('No argument!')
 
 
-def get_parent_or_409(parent_id=None, thread_id=None):
-    if parent_id is not None:
-        with get_DB_cursor() as cur:
-            sql = 'select * from posts where id = %(parent_id)s and thread_id = %(thread_id)s'
-            cur.execute(sql, {'parent_id': parent_id, 'thread_id': thread_id})
-            post = cur.fetchone()
-            return post or abort(409, parent_id)
-    raise Exception('No argument!')
+def count_rows_sql(counter, cte):
+    """CTE body adding the number of rows in `cte` to a /service/status counter.
+
+    Counters are spread over COUNTER_SHARDS rows per name, so concurrent
+    writers rarely wait on each other's row lock. The shard is the `shard`
+    parameter, see counter_shard, so every shard runs the same statement.
+    """
+    return f'''insert into counters (name, shard, value)
+                  select '{counter}', %(shard)s::smallint, count(*) from {cte} having count(*) > 0
+                  on conflict (name, shard) do update set value = counters.value + excluded.value'''
+
+
+def forum_counters_sql(forum_id, posts=0, threads=0, source=None):
+    """Statement adding to the post and thread counts of a forum, once per row of `source` if given.
 
+    Like the /service/status counters, the counts are spread over
+    COUNTER_SHARDS rows per forum, so writers to one forum do not queue on a
+    single row lock; reads sum the shards, see forum_counts_sql. The shard
+    is the `shard` parameter, as in count_rows_sql.
+    """
+    return f'''insert into forum_counters (forum_id, shard, posts, threads)
+                  select {forum_id}, %(shard)s::smallint, {posts}, {threads} {f'from {source}' if source else ''}
+                  on conflict (forum_id, shard) do update
+                      set posts = forum_counters.posts + excluded.posts,
+                          threads = forum_counters.threads + excluded.threads'''
 
-def create_forum(user_id, title, slug):
+
+def forum_counts_sql(forum_id):
+    """Query of the exact posts_count and threads_count of a forum."""
+    return f'''select coalesce(sum(posts), 0)::int as posts_count, coalesce(sum(threads), 0)::int as threads_count
+               from forum_counters where forum_id = {forum_id}'''
+
+
+def with_forum_counts(forum):
+    """Copy of a forum row with its exact posts_count and threads_count."""
     with get_DB_cursor() as cur:
-        sql = 'insert into forums (user_id, title, slug) values (%s, %s, %s) returning *'
-        cur.execute(sql, (user_id, title, slug))
-        return cur.fetchone()
+        statements.execute(cur, forum_counts_sql('%s'), (forum['id'],))
+        return dict(forum, **cur.fetchone())
 
 
-def replace_time_format(row):
-    time = row['created']
+def insert_or_select(sql, params):
+    """Rows of an insert-or-select create statement, flagged by `is_new`."""
+    for attempt in range(INSERT_OR_SELECT_ATTEMPTS):
+        with get_DB_cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        # a duplicate committed after the snapshot was taken makes the insert do
+        # nothing while the select cannot see it yet; a new snapshot will
+        if rows[0]['is_new'] is not None or not rows[0].get('found', True):
+            return rows
+    raise RuntimeError(f'create statement found neither a new nor a conflicting row in {attempt + 1} attempts')
+
+
+def counter_shard():
+    return hash((getpid(), get_ident())) % COUNTER_SHARDS
+
+
+def create_forum(nickname, title, slug):
+    """Forum row with its counts and owner's nickname, new or conflicting, flagged by `is_new`."""
+    sql = f'''with author as (
+                  select id, nickname from users where nickname = %(nickname)s
+              ), inserted as (
+                  insert into forums (user_id, title, slug)
+                  select id, %(title)s, %(slug)s::citext from author
+                  on conflict do nothing
+                  returning *
+              ), counted as ({count_rows_sql('forum', 'inserted')})
+              select a.id is not null as found, a.nickname as user_nickname, r.*
+              from (select 1) as one
+                  left join author as a on true
+                  left join (
+                      select true as is_new, i.id, i.user_id, i.title, i.slug, 0 as posts_count, 0 as threads_count
+                      from inserted as i
+                      union all
+                      select false, f.id, f.user_id, f.title, f.slug, c.posts_count, c.threads_count
+                      from forums as f
+                          cross join lateral ({forum_counts_sql('f.id')}) as c
+                      where f.slug = %(slug)s and not exists (select 1 from inserted)
+                  ) as r on true'''
+    forum = insert_or_select(sql, {'nickname': nickname, 'title': title, 'slug': slug, 'shard': counter_shard()})[0]
+    if not forum['found']:
+        abort(404, nickname)
+    return forum
+
+
+def format_time(time):
     utc_time = time.astimezone(pytz.utc)
-    row['created'] = utc_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    return utc_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def parse_time(value):
+    """Parse an ISO-8601 timestamp, with or without a UTC offset.
+
+    `Z` means UTC; without an offset the result is naive and Postgres reads
+    it in the session time zone.
+    """
+    match = TIME_PATTERN.match(value.strip())
+    if match is None:
+        abort(400, value)
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    tzinfo = None
+    if offset == 'Z':
+        tzinfo = pytz.utc
+    elif offset:
+        sign = -1 if offset[0] == '-' else 1
+        hours, minutes = int(offset[1:3]), int(offset[-2:]) if len(offset) > 3 else 0
+        tzinfo = timezone(sign * timedelta(hours=hours, minutes=minutes))
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0),
+                    int((fraction or '0').ljust(6, '0')[:6]), tzinfo=tzinfo)
+
+
+def replace_time_format(row):
+    row['created'] = format_time(row['created'])
     return row
 
 
-def create_thread(user, forum, title, message, slug=None, created=None):
-    with get_DB_cursor() as cur:
-        created = created or str(datetime.now())
-        sql = f'''update forums set threads_count = threads_count + 1 where id = %(forum_id)s;
-                  insert into forum_user (user_id, forum_id)
-                    values (%(user_id)s, %(forum_id)s) on conflict do nothing;
+def create_thread(forum_slug, nickname, title, message, slug=None, created=None):
+    """Thread row, new or the one a slug (or numeric id) refers to, flagged by `is_new`."""
+    created = created or str(datetime.now())
+    field = 'id' if slug and slug.isdigit() else 'slug'
+    insert_slug = slug if slug != '0' else ''
+    sql = f'''with forum as (
+                  select id, slug from forums where slug = %(forum_slug)s
+              ), author as (
+                  select * from users where nickname = %(nickname)s
+              ), inserted as (
                   insert into threads (user_id, forum_id, title, message, created, user_nickname, forum_slug
-                  {', slug' if slug else ''}) 
-                  values (%(user_id)s, %(forum_id)s, %(title)s, %(message)s, %(created)s, %(user_nickname)s, %(forum_slug)s {', %(slug)s' if slug else ''})
-                  returning *'''
-
-        args = {'user_id': user['id'], 'forum_id': forum['id'], 'title': title, 'slug': slug, 'message': message, 'created': created, 'user_nickname': user['nickname'], 'forum_slug': forum['slug']}
-        cur.execute(sql, args)
-        return replace_time_format(cur.fetchone())
+                  {', slug' if insert_slug else ''})
+                  select a.id, f.id, %(title)s, %(message)s, %(created)s::timestamptz, a.nickname, f.slug
+                      {', %(slug)s::citext' if insert_slug else ''}
+                  from forum as f, author as a
+                  {f'where not exists (select 1 from threads where {field} = %(slug)s)' if slug else ''}
+                  on conflict do nothing
+                  returning *
+              ), forum_threads as ({forum_counters_sql('forum_id', threads=1, source='inserted')}
+              ), forum_users as (
+                  insert into forum_user (user_id, forum_id, nickname, fullname, email, about)
+                  select a.id, i.forum_id, a.nickname, a.fullname, a.email, a.about
+                  from inserted as i, author as a
+                  on conflict do nothing
+              ), counted as ({count_rows_sql('thread', 'inserted')})
+              select exists (select 1 from forum) as forum_found,
+                  exists (select 1 from forum) and exists (select 1 from author) as found, r.*
+              from (select 1) as one
+                  left join (
+                      select true as is_new, i.* from inserted as i
+                      union all
+                      select false, t.* from threads as t
+                      where {f't.{field} = %(slug)s' if slug else 'false'}
+                          and exists (select 1 from forum) and not exists (select 1 from inserted)
+                  ) as r on true'''
+    args = {'forum_slug': forum_slug, 'nickname': nickname, 'title': title, 'message': message,
+            'created': created, 'slug': slug, 'shard': counter_shard()}
+    thread = insert_or_select(sql, args)[0]
+    if not thread['forum_found']:
+        abort(404, forum_slug)
+    if thread['is_new'] is None and not thread['found']:
+        abort(404, nickname)
+    return replace_time_format(thread)
 
 
 def create_user(nickname, fullname, email, about):
-    with get_DB_cursor() as cur:
-        sql = 'insert into users (nickname, fullname, email, about) values (%s, %s, %s, %s) returning *'
-        cur.execute(sql, (nickname, fullname, email, about))
-        return cur.fetchone()
+    """Profile of the new user, or of the users with its nickname or email, flagged by `is_new`."""
+    sql = f'''with inserted as (
+                  insert into users (nickname, fullname, email, about)
+                  values (%(nickname)s, %(fullname)s, %(email)s, %(about)s)
+                  on conflict do nothing
+                  returning *
+              ), counted as ({count_rows_sql('user', 'inserted')})
+              select r.*
+              from (select 1) as one
+                  left join (
+                      select true as is_new, nickname, email, fullname, about from inserted
+                      union all
+                      select false, nickname, email, fullname, about from users
+                      where (nickname = %(nickname)s or email = %(email)s) and not exists (select 1 from inserted)
+                  ) as r on true'''
+    return insert_or_select(sql, {'nickname': nickname, 'fullname': fullname, 'email': email, 'about': about,
+                                  'shard': counter_shard()})
 
 
 def get_dict_part(dictionary, keys):
     return {key: dictionary[key] for key in keys}
 
 
-def get_user_info_or_404(nickname=None, email=None, with_nickname=False, in_list=False):
-    with get_DB_cursor() as cur:
-        sql = f'''select {'nickname, ' if with_nickname else ''} email, fullname, about
-                  from users where {'nickname = %(nickname)s' if nickname else ''}
-                                   {' or ' if nickname and email else ''}
-                                   {'email = %(email)s' if email else ''}'''
-        cur.execute(sql, {'nickname': nickname, 'email': email})
-        return (cur.fetchall() if in_list else cur.fetchone()) or abort(404, nickname)
-    
-
-
 def get_forum_info(forum, user):
     info = get_dict_part(forum, ['slug', 'posts_count', 'title', 'threads_count'])
     info['user'] = user['nickname']
@@ -220,56 +444,68 @@ def get_thread_info(thread, forum=None, user=None, with_slug=True):
     return info
 
 
-def get_threads_info(forum_name, limit=None, since=None, is_desc=False):
+def threads_query(forum_name, limit=None, since=None, is_desc=False, as_json=False):
+    """SQL and parameters of a /forum/<slug>/threads page."""
+    if since is not None:
+        since = parse_time(since)
+
+    sql = f'''
+        select
+            t.user_nickname as author,
+            {created_sql('t.created', as_json)},
+            t.forum_slug as forum,
+            t.id,
+            t.message,
+            t.slug,
+            t.title,
+            t.votes
+        from threads as t
+        where t.forum_slug = %(forum_slug)s
+        {f"and t.created {'<=' if is_desc else '>='} %(since)s" if since else ''}
+        order by t.created {'desc' if is_desc else ''}
+        {f'limit %(limit)s' if limit else ''}
+        '''
+    return sql, {'forum_slug': forum_name, 'since': since, 'limit': limit}
+
+
+def get_threads_info(forum_name, limit=None, since=None, is_desc=False, as_json=False):
     is_desc = True if is_desc == 'true' else False
+    sql, params = threads_query(forum_name, limit, since, is_desc, as_json)
+    if as_json and not limit:
+        return stream_json_array(sql, params)
     with get_DB_cursor() as cur:
-        if since is not None:
-            since = since.replace('T', ' ').replace('Z', '')
-            if since[-6] == '+' or since[-6] == '-':
-                since = since[:-3] + since[-2:]
-                # since = datetime.strptime(since, '%Y-%m-%d %H:%M:%S.%f%z') + timedelta(hours=3)
-            else:
-                since += '000'
-                since = datetime.strptime(since, '%Y-%m-%d %H:%M:%S.%f')# + timedelta(hours=3)
-                since = format(since, '%Y-%m-%d %H:%M:%S.%f')
-
-        sql = f'''
-            select
-                t.user_nickname as author,
-                t.created,
-                t.forum_slug as forum,
-                t.id,
-                t.message,
-                t.slug,
-                t.title,
-                t.votes
-            from threads as t
-            where t.forum_slug = %(forum_slug)s
-            {f"and t.created {'<=' if is_desc else '>='} %(since)s" if since else ''}
-            order by t.created {'desc' if is_desc else ''}
-            {f'limit %(limit)s' if limit else ''}
-            '''
-        cur.execute(sql, {'forum_slug': forum_name, 'since': since, 'limit': limit})
+        if as_json:
+            statements.execute(cur, json_array_sql(sql), params)
+            return cur.fetchone()['json']
+        statements.execute(cur, sql, params)
         threads = cur.fetchall()
         return list(map(replace_time_format, threads))
 
 
-def get_forum_users_info(forum_id, limit=None, since=None, is_desc=False):
+def forum_users_query(forum_id, limit=None, since=None, is_desc=False):
+    """SQL and parameters of a /forum/<slug>/users page."""
+    sql = f'''
+        select
+            fu.nickname,
+            fu.fullname,
+            fu.email,
+            fu.about
+        from forum_user as fu
+        where fu.forum_id = %(forum_id)s
+        {f"and fu.nickname {'<' if is_desc else '>'} %(since)s" if since else ''}
+        order by fu.nickname {'desc' if is_desc else ''}
+        {f'limit %(limit)s' if limit else ''}
+        '''
+    return sql, {'forum_id': forum_id, 'since': since, 'limit': limit}
+
+
+def get_forum_users_info(forum_id, limit=None, since=None, is_desc=False, as_json=False):
+    sql, params = forum_users_query(forum_id, limit, since, is_desc)
     with get_DB_cursor() as cur:
-        sql = f'''
-            select
-                u.nickname,
-                u.fullname,
-                u.email,
-                u.about
-            from users as u 
-                inner join forum_user as fu on u.id = fu.user_id
-            where fu.forum_id = %(forum_id)s
-            {f"and u.nickname {'<' if is_desc else '>'} %(since)s" if since else ''}
-            order by u.nickname {'desc' if is_desc else ''}
-            {f'limit %(limit)s' if limit else ''}
-            '''
-        cur.execute(sql, {'forum_id': forum_id, 'since': since, 'limit': limit})
+        if as_json:
+            statements.execute(cur, json_array_sql(sql), params)
+            return cur.fetchone()['json']
+        statements.execute(cur, sql, params)
         return cur.fetchall()
 
 
@@ -286,74 +522,190 @@ def change_post_message(post_id, message=None):
         return post
 
 
-def get_post_info(post_id, what_to_show=None, thread_as_id=False):
+def post_info_query(post_id, what_to_show=None, thread_as_id=False):
+    """SQL and parameters of a post plus the requested related entities.
+
+    Related rows come back in columns named `<entity>.<field>`, see
+    `post_info_answer`.
+    """
     what_to_show = what_to_show or []
     is_author_need = 'user' in what_to_show
     is_thread_need = 'thread' in what_to_show
     is_forum_need = 'forum' in what_to_show
+    author_sql = ''',
+            u.id as "author.id",
+            u.nickname as "author.nickname",
+            u.email as "author.email",
+            u.about as "author.about",
+            u.fullname as "author.fullname"''' if is_author_need else ''
+    thread_sql = ''',
+            t.title as "thread.title",
+            t.slug as "thread.slug",
+            t.message as "thread.message",
+            t.created as "thread.created",
+            t.votes as "thread.votes",
+            t.user_nickname as "thread.user_nickname",
+            t.forum_slug as "thread.forum_slug"''' if is_thread_need else ''
+    forum_sql = ''',
+            f.slug as "forum.slug",
+            f.title as "forum.title",
+            c.posts_count as "forum.posts_count",
+            c.threads_count as "forum.threads_count",
+            fu.nickname as "forum.user_nickname"''' if is_forum_need else ''
+    forum_counts_join = f'''cross join lateral ({forum_counts_sql('f.id')}) as c'''
+    sql = f'''
+        select p.user_nickname as author,
+        p.created,
+        p.forum_slug as forum,
+        p.id,
+        p.is_edited as "isEdited",
+        p.message,
+        p.parent_id as parent,
+        {'t.id' if thread_as_id else 't.slug'} as thread,
+        t.id as thread_id
+        {author_sql}
+        {thread_sql}
+        {forum_sql}
+        from posts as p
+            join threads as t on p.thread_id = t.id
+            {'join users as u on u.id = p.user_id' if is_author_need else ''}
+            {'join forums as f on f.slug = p.forum_slug' if is_forum_need else ''}
+            {'join users as fu on fu.id = f.user_id' if is_forum_need else ''}
+            {forum_counts_join if is_forum_need else ''}
+        where p.id = %s
+        '''
+    return sql, (post_id,)
+
+
+def post_info_answer(post, what_to_show=None):
+    """Split a row of `post_info_query` into the post and its related entities."""
+    what_to_show = what_to_show or []
     answer = {}
-    with get_DB_cursor() as cur:
-        sql = f'''
-            select p.user_nickname as author,
-            p.created,
-            p.forum_slug as forum,
-            p.id,
-            p.is_edited as "isEdited",
-            p.message,
-            p.parent_id as parent,
-            {'t.id' if thread_as_id else 't.slug'} as thread,
-            t.id as thread_id
-            from posts as p
-                join threads as t on p.thread_id = t.id
-            where p.id = %s
-            '''
-        cur.execute(sql, (post_id,))
-        post = cur.fetchone()
+    related = {}
+    for key in [key for key in post if '.' in key]:
+        entity, field = key.split('.', 1)
+        related.setdefault(entity, {})[field] = post.pop(key)
+
+    answer['post'] = replace_time_format(post)
 
-        answer['post'] = replace_time_format(post)
+    if 'user' in what_to_show:
+        answer['author'] = related['author']
+    if 'thread' in what_to_show:
+        thread = replace_time_format(related['thread'])
+        thread['id'] = post['thread_id']
+        answer['thread'] = get_thread_info(thread, forum={'slug': thread['forum_slug']},
+                                           user={'nickname': thread['user_nickname']})
+    if 'forum' in what_to_show:
+        forum = related['forum']
+        answer['forum'] = get_forum_info(forum, {'nickname': forum['user_nickname']})
 
-        forum = None
-        if is_author_need:
-            user = get_user_or_404(nickname=post['author'])
-            answer['author'] = user
-        if is_thread_need:
-            forum = forum or get_forum_or_404(slug_or_id=post['forum'])
-            thread = get_thread_or_404(forum_id=forum['id'], slug_or_id=(str(post['thread'] or post['thread_id'])))
-            answer['thread'] = get_thread_info(thread, forum)
-        if is_forum_need:
-            forum = forum or get_forum_or_404(slug_or_id=post['forum'])
-            user = get_user_or_404(user_id=forum['user_id'])
-            answer['forum'] = get_forum_info(forum, user)
+    post['thread'] = post['thread'] or post['thread_id']
+    del post['thread_id']
 
-        post['thread'] = post['thread'] or post['thread_id']
-        del post['thread_id']
+    return answer
 
-        return answer
+
+def get_post_info(post_id, what_to_show=None, thread_as_id=False):
+    """Post details plus the requested related entities, in one statement.
+
+    Aborts with 404 if there is no such post.
+    """
+    with get_DB_cursor() as cur:
+        statements.execute(cur, *post_info_query(post_id, what_to_show, thread_as_id))
+        post = cur.fetchone() or abort(404, post_id)
+    return post_info_answer(post, what_to_show)
 
 
 def drop_forum():
-    with open('db_init.sql', 'r') as sql:
-        with get_DB_cursor() as cur:
-            sql = cur.mogrify(sql.read() + '\n').decode('utf-8')
-            cur.execute(sql)
+    """Empty every table and restart the id sequences, keeping the schema."""
+    with get_DB_cursor() as cur:
+        cur.execute('''truncate users, forums, threads, posts, votes, forum_user, counters, forum_counters
+                       restart identity cascade''')
+        cur.execute('select pg_notify(%s, %s)', (cache.CACHE_CHANNEL, '*'))
+    cache.reset()
+
 
+def init_schema():
+    """Drop and recreate every table, index, function and trigger from db_init.sql.
 
-def get_forum_status():
+    With POSTS_PARTITIONS, posts is then recreated by db_init_partitioned.sql
+    as a table of that many hash partitions, which needs Postgres 11; on an
+    older server nothing is touched and RuntimeError is raised.
+    """
+    paths = ['db_init.sql'] + (['db_init_partitioned.sql'] if POSTS_PARTITIONS else [])
     with get_DB_cursor() as cur:
-        answer = {}
-        sql = 'select count(*) as c from forums'
-        cur.execute(sql)
-        answer['forum'] = cur.fetchone()['c']
-        sql = 'select count(*) as c from posts'
-        cur.execute(sql)
-        answer['post'] = cur.fetchone()['c']
-        sql = 'select count(*) as c from threads'
-        cur.execute(sql)
-        answer['thread'] = cur.fetchone()['c']
-        sql = 'select count(*) as c from users'
-        cur.execute(sql)
-        answer['user'] = cur.fetchone()['c']
-        return answer
+        if POSTS_PARTITIONS:
+            cur.execute("select current_setting('server_version_num')::int as version")
+            version = cur.fetchone()['version']
+            if version < 110000:
+                raise RuntimeError(f'FORUM_POSTS_PARTITIONS needs Postgres 11 or later, the server is {version}')
+        cur.execute("select set_config('forum.posts_partitions', %s, true)", (str(POSTS_PARTITIONS),))
+        for path in paths:
+            with open(path, 'r') as sql:
+                cur.execute(cur.mogrify(sql.read() + '\n').decode('utf-8'))
+        cur.execute('select pg_notify(%s, %s)', (cache.CACHE_CHANNEL, '*'))
+    cache.reset()
+
+
+def status_query(approximate=False):
+    """SQL of the row counts for /service/status.
+
+    Exact counts come from the counters maintained by the write paths; the
+    approximate ones are the planner's estimates from pg_class.
+    """
+    if approximate:
+        # a partitioned posts table has its estimates on its partitions
+        return '''select trim(trailing 's' from t.relname) as name, greatest(sum(c.reltuples), 0)::bigint as value
+                  from pg_class as t
+                      left join pg_inherits as i on i.inhparent = t.oid
+                      join pg_class as c on c.oid = coalesce(i.inhrelid, t.oid)
+                  where t.relname in ('forums', 'posts', 'threads', 'users') and t.relkind in ('r', 'p')
+                  group by t.relname'''
+    return 'select name, sum(value)::bigint as value from counters group by name'
+
+
+def status_answer(rows):
+    answer = {'forum': 0, 'post': 0, 'thread': 0, 'user': 0}
+    answer.update((row['name'], row['value']) for row in rows)
+    return answer
+
+
+def get_forum_status(approximate=False):
+    with get_DB_cursor() as cur:
+        statements.execute(cur, status_query(approximate))
+        return status_answer(cur.fetchall())
+
+
+def get_posts_references(cur, thread_id, posts):
+    """Resolve every author and parent of a batch of posts in one query.
+
+    Aborts with 404 on the first unknown author and with 409 on the first
+    parent that is missing from the thread, in the order of the batch.
+    """
+    nicknames = list({post['author'] for post in posts})
+    parent_ids = list({post['parent'] for post in posts if post.get('parent')})
+    sql = '''
+        select 'user' as kind, n.nickname::text as key, u.id
+        from unnest(%(nicknames)s::citext[]) as n(nickname)
+            join users as u on u.nickname = n.nickname
+        union all
+        select 'parent', p.id::text, p.id
+        from posts as p
+        where p.thread_id = %(thread_id)s and p.id = any(%(parent_ids)s::int[])
+        '''
+    statements.execute(cur, sql, {'nicknames': nicknames, 'parent_ids': parent_ids, 'thread_id': thread_id})
+    found = {(row['kind'], row['key']): row['id'] for row in cur.fetchall()}
+
+    user_ids = {}
+    for post in posts:
+        user_id = found.get(('user', post['author']))
+        if user_id is None:
+            abort(404, post['author'])
+        user_ids[post['author']] = user_id
+    for post in posts:
+        if post.get('parent') and ('parent', str(post['parent'])) not in found:
+            abort(409, post['parent'])
+    return user_ids
 
 
 def add_posts(thread_id, posts, forum_id, forum_slug):
@@ -361,23 +713,58 @@ def add_posts(thread_id, posts, forum_id, forum_slug):
         return []
     time = str(datetime.now())
     with get_DB_cursor() as cur:
-        posts_len = len(posts) - 1
-        sql = f'''update forums set posts_count = posts_count + {len(posts)} where id = %s;
-             insert into forum_user (user_id, forum_id)
-                values (%s, %s) {', (%s, %s)' * posts_len} on conflict do nothing;
-             insert into posts (user_id, thread_id, message, created, parent_id, forum_slug, user_nickname) values
-             (%s, %s, %s, %s, %s, %s, %s) {', (%s, %s, %s, %s, %s, %s, %s)' * posts_len} returning *'''
-        args = [forum_id]
-        for post in posts:
-            user = get_user_or_404(nickname=post['author'])
-            args += (user['id'], forum_id)
-        for post in posts:
-            user = get_user_or_404(nickname=post['author'])
-            if post.get('parent'):
-                get_parent_or_409(parent_id=post['parent'], thread_id=thread_id)                    
-            args += (user['id'], thread_id, post['message'], time, post.get('parent', 0), forum_slug, post['author'])
-        cur.execute(sql, args)
-        return cur.fetchall()
+        user_ids = get_posts_references(cur, thread_id, posts)
+        sql = f'''{forum_counters_sql('%(forum_id)s', posts='%(posts_count)s')};
+             insert into forum_user (user_id, forum_id, nickname, fullname, email, about)
+                select id, %(forum_id)s, nickname, fullname, email, about
+                from users where id = any(%(authors)s::int[])
+                on conflict do nothing;
+             with batch as (
+                 select *
+                 from unnest(%(user_ids)s::int[], %(messages)s::text[], %(parent_ids)s::int[], %(nicknames)s::citext[])
+                     with ordinality as b(user_id, message, parent_id, user_nickname, ord)
+             ), numbered as (
+                 select b.*, nextval('posts_id_seq') as id from batch as b order by b.ord
+             ), inserted as (
+                 insert into posts (id, user_id, thread_id, message, created, parent_id, forum_slug, user_nickname,
+                                    parent_path, root_id)
+                 select n.id, n.user_id, %(thread_id)s, n.message, %(created)s, n.parent_id, %(forum_slug)s, n.user_nickname,
+                     case when n.parent_id = 0 then array[0, n.id]
+                          else parent.parent_path || n.id end,
+                     case when n.parent_id = 0 then n.id else parent.root_id end
+                 from numbered as n
+                     left join posts as parent on parent.thread_id = %(thread_id)s and parent.id = n.parent_id
+                 order by n.id
+                 returning user_nickname as author,
+                     created,
+                     forum_slug as forum,
+                     id,
+                     is_edited as "isEdited",
+                     message,
+                     parent_id as parent,
+                     thread_id as thread,
+                     parent_path
+             ), counted as ({count_rows_sql('post', 'inserted')})
+             select * from inserted order by id'''
+        cur.execute(sql, {
+            'posts_count': len(posts),
+            'forum_id': forum_id,
+            'authors': list(set(user_ids.values())),
+            'user_ids': [user_ids[post['author']] for post in posts],
+            'messages': [post['message'] for post in posts],
+            'parent_ids': [post.get('parent') or 0 for post in posts],
+            'nicknames': [post['author'] for post in posts],
+            'thread_id': thread_id,
+            'created': time,
+            'forum_slug': forum_slug,
+            'shard': counter_shard(),
+        })
+        rows = cur.fetchall()
+        if tree_index.index.enabled:
+            tree_index.index.publish(cur, thread_id, [(row['id'], row['parent']) for row in rows])
+    if tree_index.index.enabled:
+        tree_index.index.add(thread_id, [(row['id'], row['parent']) for row in rows])
+    return rows
 
 
 def change_user(nickname, about=None, email=None, fullname=None):
@@ -385,12 +772,23 @@ def change_user(nickname, about=None, email=None, fullname=None):
         if about is None and email is None and fullname is None:
             sql = 'select * from users where nickname = %(nickname)s'
         else:
-            sql = f'''update users set {'about = %(about)s' if about else ''} {',' if about and (email or fullname) else ''}
-                                       {'email = %(email)s' if email else ''} {',' if email and fullname else ''}
-                                       {'fullname = %(fullname)s' if fullname else ''}
-                                       where nickname = %(nickname)s returning *'''
+            sql = f'''with updated as (
+                          update users set version = version + 1
+                                           {', about = %(about)s' if about else ''}
+                                           {', email = %(email)s' if email else ''}
+                                           {', fullname = %(fullname)s' if fullname else ''}
+                                           where nickname = %(nickname)s returning *
+                      ), copies as (
+                          update forum_user as fu
+                          set fullname = updated.fullname, email = updated.email, about = updated.about
+                          from updated where fu.user_id = updated.id
+                      )
+                      select * from updated'''
         cur.execute(sql, {'nickname': nickname, 'about': about, 'email': email, 'fullname': fullname})
-        return cur.fetchone()
+        user = cur.fetchone()
+        if user is not None:
+            cache.users.invalidate(user['id'])
+        return user
 
 
 def change_thread(thread, message=None, title=None):
@@ -398,41 +796,81 @@ def change_thread(thread, message=None, title=None):
         if message is None and title is None:
             sql = 'select * from threads where id = %(thread_id)s' 
         else:
-            sql = f'''update threads set {'message = %(message)s' if message else ''}
-                                         {',' if message and title else ''}
-                                         {'title = %(title)s' if title else ''}
+            sql = f'''update threads set version = version + 1
+                                         {', message = %(message)s' if message else ''}
+                                         {', title = %(title)s' if title else ''}
                       where id = %(thread_id)s returning *'''
         cur.execute(sql, {'thread_id': thread['id'], 'message': message, 'title': title})
+        cache.threads.invalidate(thread['id'])
         return replace_time_format(cur.fetchone())
 
 
 def create_vote(thread, user, voice):
-    with get_DB_cursor() as cur:
-        user_id = user['id']
-        thread_id = thread['id']
-        sql = 'select voice from votes where user_id = %s and thread_id = %s'
-        cur.execute(sql, (user_id, thread_id))
-        result = cur.fetchone()
-        old_voice = result['voice'] if result else None
-        if old_voice is not None:
-            delta = voice - old_voice
-            if delta != 0:
-                sql = '''--select from threads where id = %(thread_id)s for update;
-                         update threads set votes = votes + %(delta)s where id = %(thread_id)s;
-                         update votes set voice = %(voice)s where user_id = %(user_id)s and thread_id = %(thread_id)s'''
-                cur.execute(sql, {'delta': delta, 'thread_id': thread_id, 'voice': voice, 'user_id': user_id})
-        else:
-            sql = '''insert into votes (thread_id, user_id, voice) values (%s, %s, %s);
-                     update threads set votes = votes + %s where id = %s'''
-            cur.execute(sql, (thread_id, user_id, voice, voice, thread_id))
-
-
-def get_posts(thread, limit=None, since=None, sort=None, is_desc=False):
+    """Record `user`'s vote and return the thread with its new vote total.
+
+    One statement upserts the vote, derives the change from the voice it
+    replaces and applies it to the thread. Hot threads in coalescing mode
+    skip the thread update and leave the change to `votes.coalescer`.
+    """
+    coalesce = votes.coalescer.is_hot(thread['id'])
+    # `previous` cannot lock a first vote that a concurrent request is still
+    # inserting; when the insert then hits it, `raced` asks for a retry
+    vote_sql = '''with previous as (
+                    select voice from votes
+                    where user_id = %(user_id)s and thread_id = %(thread_id)s
+                    for update
+                ), voted as (
+                    insert into votes (user_id, thread_id, voice) values (%(user_id)s, %(thread_id)s, %(voice)s)
+                    on conflict (user_id, thread_id) do update set voice = excluded.voice
+                    returning voice, xmax = 0 as inserted
+                ), delta as (
+                    select (select voice from voted) - coalesce((select voice from previous), 0) as value,
+                        not (select inserted from voted) and not exists (select 1 from previous) as raced
+                )'''
+    if coalesce:
+        sql = f'''{vote_sql}
+                  select t.*, delta.value as delta, delta.raced from threads as t, delta where t.id = %(thread_id)s'''
+    else:
+        sql = f'''{vote_sql}, updated as (
+                      update threads set votes = threads.votes + delta.value, version = threads.version + 1
+                      from delta
+                      where threads.id = %(thread_id)s and delta.value <> 0
+                      returning threads.*
+                  )
+                  select t.*, delta.raced
+                  from (select * from updated
+                        union all
+                        select * from threads where id = %(thread_id)s and not exists (select 1 from updated)) as t,
+                      delta'''
+    while True:
+        with get_DB_cursor() as cur:
+            statements.execute(cur, sql, {'user_id': user['id'], 'thread_id': thread['id'], 'voice': voice})
+            new_thread = cur.fetchone()
+            if new_thread.pop('raced'):
+                # the other vote is committed now, so the next statement locks it as `previous`
+                cur.connection.rollback()
+                continue
+        break
+    if coalesce:
+        delta = new_thread.pop('delta')
+        if delta:
+            votes.coalescer.add(thread['id'], delta)
+    new_thread['votes'] += votes.coalescer.pending(thread['id'])
+    cache.threads.invalidate(thread['id'])
+    return replace_time_format(new_thread)
+
+
+def posts_query(thread_id, limit=None, since=None, sort=None, is_desc=False, as_json=False, page_ids=None):
+    """SQL and parameters of a /thread/<slug_or_id>/posts page.
+
+    With `page_ids`, the ids of the page in order as given by the tree
+    index, the posts are fetched by primary key instead.
+    """
     sort = sort or 'flat'
-    select_from_sql = '''
+    select_from_sql = f'''
         select
             p.user_nickname as author,
-            p.created,
+            {created_sql('p.created', as_json)},
             p.forum_slug as forum,
             p.id,
             p.is_edited as isEdited,
@@ -444,51 +882,71 @@ def get_posts(thread, limit=None, since=None, sort=None, is_desc=False):
     desc_sql = 'desc' if is_desc else ''
     limit_sql = 'limit %(limit)s' if limit else ''
     compare_sign = '<' if is_desc else '>'
-    compare_sign_reverce = '>' if is_desc else '<'
-    since_sql = f'''and parent_path {compare_sign} (select parent_path
-                                                      from posts where id = {since})''' if since else ''
-    since_sql_reverce = f'''and ((select parent_path
-                                 from posts where id = {since})''' if since else ''
+    since_sql = f'''and parent_path {compare_sign} (select parent_path from posts
+                                                      where thread_id = %(thread_id)s and id = %(since)s)''' if since else ''
+    since_root_sql = f'''and r.id {compare_sign} (select root_id from posts
+                                                  where thread_id = %(thread_id)s and id = %(since)s)''' if since else ''
 
-    with get_DB_cursor() as cur:
-        if sort == 'flat':
-            sql = f'''
-                {select_from_sql}
-                where p.thread_id = %(thread_id)s
-                {f'and p.id {compare_sign} %(since)s' if since else ''}
-                order by p.created {desc_sql},
-                    p.id {desc_sql}
-                {limit_sql}
-                '''
-
-        elif sort == 'tree':
-            sql = f'''
-                {select_from_sql}
-                where p.thread_id = %(thread_id)s
-                {since_sql}
-                order by p.parent_path {desc_sql}, p.id {desc_sql}
-                {limit_sql}
-                '''
-
-        elif sort == 'parent_tree':
-            sql = f''' set random_page_cost=0; set enable_hashjoin=false; set enable_mergejoin=false;
-            select p2.user_nickname as author,
-            p2.created,
-            p2.forum_slug as forum,
-            p2.id,
-            p2.is_edited as isEdited,
-            p2.message,
-            p2.parent_id as parent,
-            p2.thread_id as thread
-                from (select id from posts where thread_id = %(thread_id)s and parent_id = 0
-                      {since_sql}
-                      order by id {desc_sql} {limit_sql}) as p1
-                    inner join (select * from posts as p2 where p2.parent_path[2] = any(select id from posts)) as p2 on p1.id = p2.parent_path[2]
-                order by p2.parent_path {desc_sql}
-                '''
-
-        # print(cur.mogrify(sql, {'thread_id': thread['id'], 'since': since, 'limit': limit}).decode('utf-8'), file=stderr)
-        cur.execute(sql, {'thread_id': thread['id'], 'since': since, 'limit': limit})
+    if sort == 'flat':
+        sql = f'''
+            {select_from_sql}
+            where p.thread_id = %(thread_id)s
+            {f'and p.id {compare_sign} %(since)s' if since else ''}
+            order by p.created {desc_sql},
+                p.id {desc_sql}
+            {limit_sql}
+            '''
+
+    elif sort == 'tree':
+        sql = f'''
+            {select_from_sql}
+            where p.thread_id = %(thread_id)s
+            {since_sql}
+            order by p.parent_path {desc_sql}, p.id {desc_sql}
+            {limit_sql}
+            '''
+
+    elif sort == 'parent_tree':
+        # a page is `limit` root posts after (or before) the root of the
+        # `since` post, each followed by its whole subtree
+        sql = f'''
+            {select_from_sql}
+            where p.thread_id = %(thread_id)s
+                and p.root_id = any(array(
+                    select r.id
+                    from posts as r
+                    where r.thread_id = %(thread_id)s and r.parent_id = 0
+                    {since_root_sql}
+                    order by r.id {desc_sql}
+                    {limit_sql}))
+            order by p.root_id {desc_sql}, p.parent_path {desc_sql}
+            '''
+
+    if page_ids is not None:
+        sql = f'''
+            {select_from_sql}
+                join unnest(%(ids)s::int[]) with ordinality as page(id, position) on page.id = p.id
+            where p.thread_id = %(thread_id)s
+            order by page.position
+            '''
+    return sql, {'thread_id': thread_id, 'since': since, 'limit': limit, 'ids': page_ids}
+
+
+def get_posts(thread, limit=None, since=None, sort=None, is_desc=False, as_json=False):
+    page_ids = None
+    if limit and sort in ('tree', 'parent_tree'):
+        page_ids = tree_index.index.page(thread['id'], sort, since, limit, is_desc)
+    sql, params = posts_query(thread['id'], limit, since, sort, is_desc, as_json,
+                              list(page_ids) if page_ids is not None else None)
+    # print(cur.mogrify(sql, params).decode('utf-8'), file=stderr)
+    if as_json and not limit:
+        return stream_json_array(sql, params)
+    # the index is built on the primary; a lagging replica would drop its newest posts from the page
+    with get_DB_cursor(primary=page_ids is not None) as cur:
+        if as_json:
+            statements.execute(cur, json_array_sql(sql), params)
+            return cur.fetchone()['json']
+        statements.execute(cur, sql, params)
         return list(map(replace_time_format, cur.fetchall()))
 
 
@@ -496,44 +954,29 @@ def get_posts(thread, limit=None, since=None, sort=None, is_desc=False):
 def _create_forum():
     data = request.get_json()
 
-    user = get_user_or_404(nickname=data['user'])
-    forum = get_forum_or_404(slug_or_id=data['slug'], abort404=False)
-
-    status = CONFLICT
-    if not forum:
-        status = CREATED
-        forum = create_forum(user['id'], data['title'], data['slug'])
-
-    return make_response(status, get_forum_info(forum, user))
+    forum = create_forum(data['user'], data['title'], data['slug'])
+    status = CREATED if forum['is_new'] else CONFLICT
+    return make_response(status, get_forum_info(forum, {'nickname': forum['user_nickname']}))
 
 
 @forum_blueprint.route('/forum/<slug>/create', methods=['POST'])
 def _create_thread(slug):
     data = request.get_json()
 
-    thread_slug = data.get('slug')
-
-    forum = get_forum_or_404(slug_or_id=slug)
-    thread = get_thread_or_404(forum_id=forum['id'], slug_or_id=thread_slug, abort404=False) if thread_slug else None
-    user = get_user_or_404(user_id=thread['user_id']) if thread is not None else get_user_or_404(nickname=data['author'])
-    if thread is not None:
-        forum = get_forum_or_404(slug_or_id=thread['forum_id'])
-
-    status = CONFLICT
-    if thread is None:
-        status = CREATED
-        thread = create_thread(user, forum, data['title'], data['message'],
-                               slug=thread_slug if thread_slug != '0' else '', created=data.get('created'))
+    thread = create_thread(slug, data['author'], data['title'], data['message'],
+                           slug=data.get('slug'), created=data.get('created'))
+    status = CREATED if thread['is_new'] else CONFLICT
 
     with_slug = data.get('slug') is not None
-    return make_response(status, get_thread_info(thread, forum, user, with_slug=with_slug))
+    return make_response(status, get_thread_info(thread, forum={'slug': thread['forum_slug']},
+                                                 user={'nickname': thread['user_nickname']}, with_slug=with_slug))
 
 
 @forum_blueprint.route('/forum/<slug>/details')
 def get_forum_details(slug):
-    forum = get_forum_or_404(slug_or_id=slug)
+    forum = with_forum_counts(get_forum_or_404(slug_or_id=slug))
     user = get_user_or_404(user_id=forum['user_id'])
-    return make_response(OK, get_forum_info(forum, user))
+    return conditional_response(forum_etag(forum, user), lambda: make_response(OK, get_forum_info(forum, user)))
 
 
 @forum_blueprint.route('/forum/<slug>/threads')
@@ -542,8 +985,8 @@ def get_forum_threads(slug):
     limit = request.args.get('limit')
     since = request.args.get('since')
     desc = request.args.get('desc')
-    threads = get_threads_info(slug, limit, since, desc)
-    return make_response(OK, threads)
+    threads = get_threads_info(slug, limit, since, desc, as_json=True)
+    return make_json_response(OK, threads)
 
 
 @forum_blueprint.route('/forum/<slug>/users')
@@ -552,13 +995,12 @@ def get_thread_users(slug):
     limit = request.args.get('limit')
     since = request.args.get('since')
     desc = request.args.get('desc') == 'true'
-    users = get_forum_users_info(forum['id'], limit, since, desc)
-    return make_response(OK, users)
+    users = get_forum_users_info(forum['id'], limit, since, desc, as_json=True)
+    return make_json_response(OK, users)
 
 
 @forum_blueprint.route('/post/<p_id>/details', methods=['GET'])
 def get_post_details(p_id):
-    post = get_post_or_404(post_id=p_id)
     what_to_show = request.args.get('related')
     what_to_show = what_to_show.split(',') if what_to_show is not None else None
     posts = get_post_info(p_id, what_to_show, thread_as_id=True)
@@ -578,9 +1020,32 @@ def clear_forum():
     return make_response(OK, 'Forum database cleared')
 
 
+@forum_blueprint.route('/service/schema', methods=['POST'])
+def recreate_schema():
+    try:
+        init_schema()
+    except RuntimeError as error:
+        return make_response(500, {'message': str(error)})
+    return make_response(OK, 'Forum database schema recreated')
+
+
 @forum_blueprint.route('/service/status')
 def get_status():
-    return make_response(OK, get_forum_status())
+    return make_response(OK, get_forum_status(approximate=request.args.get('approximate') == 'true'))
+
+
+@forum_blueprint.route('/service/metrics')
+def get_service_metrics():
+    return make_response(OK, metrics.collect())
+
+
+@forum_blueprint.route('/service/stats')
+def get_service_stats():
+    return make_response(OK, {
+        'cache': cache.stats(),
+        'statements': statements.stats(),
+        'tree_index': tree_index.index.stats(),
+    })
 
 
 @forum_blueprint.route('/thread/<slug_or_id>/create', methods=['POST'])
@@ -589,14 +1054,19 @@ def create_posts(slug_or_id):
     thread = get_thread_or_404(slug_or_id=slug_or_id)
     forum = get_forum_or_404(slug_or_id=thread['forum_id'])
     posts = add_posts(thread['id'], data, forum_id=thread['forum_id'], forum_slug=forum['slug'])
-    posts = [get_post_info(p['id'], thread_as_id=True)['post'] for p in posts]
+    formatted = {}
+    for post in posts:
+        del post['parent_path']
+        if post['created'] not in formatted:
+            formatted[post['created']] = format_time(post['created'])
+        post['created'] = formatted[post['created']]
     return make_response(CREATED, posts)
 
 
 @forum_blueprint.route('/thread/<slug_or_id>/details', methods=['GET'])
 def _get_thread_details(slug_or_id):
     thread = get_thread_or_404(slug_or_id=slug_or_id)
-    return make_response(OK, get_thread_info(thread))
+    return conditional_response(thread_etag(thread), lambda: make_response(OK, get_thread_info(thread)))
 
 
 @forum_blueprint.route('/thread/<slug_or_id>/details', methods=['POST'])
@@ -615,9 +1085,9 @@ def _get_posts(slug_or_id):
     desc = request.args.get('desc')
 
     thread = get_thread_or_404(slug_or_id=slug_or_id)
-    posts = get_posts(thread, limit, since, sort, desc == 'true')
+    posts = get_posts(thread, limit, since, sort, desc == 'true', as_json=True)
 
-    return make_response(OK, posts)
+    return make_json_response(OK, posts)
 
     pass
 
@@ -627,31 +1097,28 @@ def _change_vote(slug_or_id):
     data = request.get_json()
     thread = get_thread_or_404(slug_or_id=slug_or_id)
     user = get_user_or_404(nickname=data['nickname'])
-    create_vote(thread, user, int(data['voice']))
-    thread = get_thread_or_404(slug_or_id=slug_or_id)
-    return make_response(OK, get_thread_info(thread))
+    thread = create_vote(thread, user, int(data['voice']))
+    return make_response(OK, get_thread_info(thread, forum={'slug': thread['forum_slug']},
+                                             user={'nickname': thread['user_nickname']}))
 
 
 @forum_blueprint.route('/user/<nickname>/create', methods=['POST'])
 def _create_user(nickname):
     data = request.get_json()
 
-    try:
-        user = get_user_info_or_404(nickname=nickname, email=data['email'], in_list=True, with_nickname=True)
-        return make_response(CONFLICT, user)
-    except:
-        pass
-
-    user = create_user(nickname, data['fullname'], data['email'], data['about'])
+    users = create_user(nickname, data['fullname'], data['email'], data['about'])
+    is_new = users[0].pop('is_new')
+    for user in users[1:]:
+        del user['is_new']
 
-    return make_response(CREATED, get_user_info_or_404(nickname=user['nickname'],
-                                                      email=user['email'],
-                                                      with_nickname=True))
+    return make_response(CREATED, users[0]) if is_new else make_response(CONFLICT, users)
 
 
 @forum_blueprint.route('/user/<nickname>/profile', methods=['GET'])
 def _get_user_info(nickname):
-    return make_response(OK, get_user_info_or_404(nickname=nickname, with_nickname=True))
+    user = get_user_or_404(nickname=nickname)
+    return conditional_response(user_etag(user), lambda: make_response(
+        OK, get_dict_part(user, ['nickname', 'email', 'fullname', 'about'])))
 
 
 @forum_blueprint.route('/user/<nickname>/profile', methods=['POST'])
@@ -663,4 +1130,4 @@ def _change_user(nickname):
         return make_response(CONFLICT, {'message': data['email']})
     else:
         user = change_user(nickname, about=data.get('about'), email=data.get('email'), fullname=data.get('fullname'))
-        return make_response(OK, user)
+        return make_response(OK, get_dict_part(user, ['nickname', 'email', 'fullname', 'about']))
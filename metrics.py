@@ -0,0 +1,173 @@
+"""Latency histograms per endpoint and per query shape.
+
+Each worker records into its own histograms and writes a snapshot of them to
+METRICS_DIR at most every METRICS_DUMP_INTERVAL seconds. `collect` merges the
+snapshots of all workers, so /service/metrics shows the whole server no
+matter which worker answers it. Remove METRICS_DIR to start from scratch.
+"""
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from os import environ, getpid
+from sys import stderr
+import psycopg2.extras
+
+METRICS_DIR = environ.get('FORUM_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'forum_metrics'))
+METRICS_DUMP_INTERVAL = float(environ.get('FORUM_METRICS_DUMP_INTERVAL', 1))
+
+TIME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, snapshot):
+        for index, value in enumerate(snapshot['counts']):
+            self.counts[index] += value
+        self.count += snapshot['count']
+        self.sum += snapshot['sum']
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'count': self.count, 'sum': self.sum}
+
+    def report(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'buckets': dict(zip([str(bound) for bound in self.bounds] + ['+Inf'], self.counts)),
+        }
+
+
+class TimedCursor(psycopg2.extras.RealDictCursor):
+    """RealDictCursor that reports the time of every statement it runs."""
+
+    def execute(self, query, vars=None):
+        start = time.monotonic()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, time.monotonic() - start)
+
+    def execute_untimed(self, query, vars=None):
+        """Run a step of a statement that statements.execute times as a whole."""
+        return super().execute(query, vars)
+
+
+_histograms = {}
+_lock = threading.Lock()
+_request = threading.local()
+_last_dump = 0
+
+
+def _observe(group, key, metric, value, bounds=TIME_BUCKETS):
+    with _lock:
+        histogram = _histograms.get((group, key, metric))
+        if histogram is None:
+            histogram = _histograms[(group, key, metric)] = Histogram(bounds)
+        histogram.observe(value)
+
+
+def query_shape(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return ' '.join(str(query).split())[:300]
+
+
+def record_query(query, seconds):
+    _observe('queries', query_shape(query), 'ms', seconds * 1000)
+    if getattr(_request, 'start', None) is not None:
+        _request.queries += 1
+        _request.sql += seconds
+
+
+def record_serialization(seconds):
+    if getattr(_request, 'start', None) is not None:
+        _request.serialization += seconds
+
+
+def start_request():
+    _request.start = time.monotonic()
+    _request.queries = 0
+    _request.sql = 0
+    _request.serialization = 0
+
+
+def finish_request(endpoint):
+    if getattr(_request, 'start', None) is None:
+        return
+    total = time.monotonic() - _request.start
+    _request.start = None
+    _observe('endpoints', endpoint, 'latency_ms', total * 1000)
+    _observe('endpoints', endpoint, 'sql_ms', _request.sql * 1000)
+    _observe('endpoints', endpoint, 'serialization_ms', _request.serialization * 1000)
+    _observe('endpoints', endpoint, 'python_ms', (total - _request.sql - _request.serialization) * 1000)
+    _observe('endpoints', endpoint, 'queries', _request.queries, COUNT_BUCKETS)
+    if time.monotonic() - _last_dump > METRICS_DUMP_INTERVAL:
+        try:
+            dump()
+        except OSError as error:
+            print(error, file=stderr)
+
+
+def record_request(endpoint, seconds):
+    """Latency of a request served outside the Flask request cycle, e.g. by async_main."""
+    _observe('endpoints', endpoint, 'latency_ms', seconds * 1000)
+
+
+def dump():
+    """Write this worker's histograms to METRICS_DIR."""
+    global _last_dump
+    _last_dump = time.monotonic()
+    with _lock:
+        snapshot = [[group, key, metric, histogram.bounds, histogram.snapshot()]
+                    for (group, key, metric), histogram in _histograms.items()]
+    if not snapshot:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{getpid()}.json')
+    with open(path + '.tmp', 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(path + '.tmp', path)
+
+
+def collect():
+    """Histograms of every worker, merged."""
+    dump()
+    merged = {}
+    for name in os.listdir(METRICS_DIR) if os.path.isdir(METRICS_DIR) else []:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue  # being replaced by its worker
+        for group, key, metric, bounds, data in snapshot:
+            histogram = merged.get((group, key, metric))
+            if histogram is None:
+                histogram = merged[(group, key, metric)] = Histogram(tuple(bounds))
+            histogram.merge(data)
+
+    report = {'endpoints': {}, 'queries': {}}
+    for (group, key, metric), histogram in sorted(merged.items()):
+        report[group].setdefault(key, {})[metric] = histogram.report()
+    return report
+
+
+atexit.register(dump)
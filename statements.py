@@ -0,0 +1,109 @@
+"""Registry of named prepared statements.
+
+Each distinct SQL text gets a stable name derived from its hash. The first
+time a pooled connection runs it, the statement is PREPAREd there, and every
+later run on that connection is an EXECUTE, which skips parsing and
+planning in Postgres.
+"""
+import re
+import threading
+import time
+from hashlib import sha1
+import metrics
+
+PARAM_PATTERN = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+class Statement:
+    def __init__(self, sql):
+        self.source = ' '.join(sql.split())
+        self.name = 'forum_' + sha1(self.source.encode('utf-8')).hexdigest()[:16]
+        self.param_names = []
+        self.positional = 0
+        self.sql = PARAM_PATTERN.sub(self._placeholder, self.source)
+        self.prepares = 0
+        self.executions = 0
+
+    def _placeholder(self, match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is None:
+            self.positional += 1
+            return f'${self.positional}'
+        if match.group(1) not in self.param_names:
+            self.param_names.append(match.group(1))
+        return f'${self.param_names.index(match.group(1)) + 1}'
+
+    def values(self, params):
+        if self.param_names:
+            return [params[name] for name in self.param_names]
+        return list(params or ())
+
+    def stats(self):
+        return {
+            'sql': self.source,
+            'prepares': self.prepares,
+            'executions': self.executions,
+            'hit_rate': 1 - self.prepares / self.executions if self.executions else None,
+        }
+
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def get_statement(sql):
+    statement = _registry.get(sql)
+    if statement is None:
+        with _lock:
+            statement = _registry.setdefault(sql, Statement(sql))
+    return statement
+
+
+def steps(connection, sql, params=None):
+    """Queries and arguments, in order, that run `sql` as a prepared statement on `connection`.
+
+    Each step is only taken once the previous one has run, so a failed
+    PREPARE is retried next time.
+    """
+    prepared = getattr(connection, 'prepared', None)
+    if prepared is None:
+        yield sql, params
+        return
+
+    statement = get_statement(sql)
+    if statement.name not in prepared:
+        yield f'prepare {statement.name} as {statement.sql}', None
+        prepared.add(statement.name)
+        statement.prepares += 1
+    values = statement.values(params)
+    arguments = f' ({", ".join(["%s"] * len(values))})' if values else ''
+    yield f'execute {statement.name}{arguments}', values or None
+    statement.executions += 1
+
+
+def execute(cur, sql, params=None):
+    """Run `sql` with `params` as a prepared statement on the cursor's connection.
+
+    Its time, PREPARE included, is recorded under the SQL text rather than
+    the EXECUTE of its generated name.
+    """
+    run = cur.execute_untimed if isinstance(cur, metrics.TimedCursor) else cur.execute
+    start = time.monotonic()
+    try:
+        for query, arguments in steps(cur.connection, sql, params):
+            run(query, arguments)
+    finally:
+        metrics.record_query(sql, time.monotonic() - start)
+
+
+def stats():
+    statements = list(_registry.values())
+    prepares = sum(statement.prepares for statement in statements)
+    executions = sum(statement.executions for statement in statements)
+    return {
+        'prepares': prepares,
+        'executions': executions,
+        'hit_rate': 1 - prepares / executions if executions else None,
+        'statements': {statement.name: statement.stats() for statement in statements},
+    }
@@ -0,0 +1,269 @@
+"""In-memory index of the posts of hot threads in tree order.
+
+For every indexed thread a worker keeps the post ids ordered by parent_path
+in an int array, and the depth of each post in a parallel bytearray. A
+`sort=tree` or `sort=parent_tree` page is then a slice of the array, and
+Postgres only has to fetch the posts of the page by primary key.
+
+Threads are indexed lazily on their first tree page and evicted in LRU
+order beyond TREE_INDEX_THREADS (0, the default, disables the index). Posts
+created by this worker are inserted directly; posts created by the other
+workers arrive as `posts:` notifications on the cache channel, so the index
+lives and dies with the cache's listening connection.
+"""
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from os import environ, getpid, urandom
+import cache
+from connect_db import get_DB_cursor
+
+TREE_INDEX_THREADS = int(environ.get('FORUM_TREE_INDEX_THREADS', 0))
+NOTIFY_CHUNK_SIZE = 500  # keeps payloads well below the 8000 byte limit
+MAX_DEPTH = 255
+UNINDEXABLE_THREADS = 1000  # threads remembered as too deep to index
+
+_shallower_patterns = {}
+
+
+def shallower(depth):
+    """Pattern matching a depth of at most `depth` in a depths bytearray."""
+    pattern = _shallower_patterns.get(depth)
+    if pattern is None:
+        pattern = _shallower_patterns[depth] = re.compile(b'[\\x00-' + re.escape(bytes([depth])) + b']')
+    return pattern
+
+
+class ThreadTree:
+    """Post ids of one thread in parent_path order, with their depths."""
+
+    def __init__(self, ids, depths):
+        self.ids = ids
+        self.depths = depths
+
+    def position(self, post_id):
+        try:
+            return self.ids.index(post_id)
+        except ValueError:
+            return None
+
+    def insert(self, post_id, parent_id):
+        """Insert a post after its existing siblings with smaller ids; False if it does not fit."""
+        if parent_id == 0:
+            depth, start, end = 0, 0, len(self.ids)
+        else:
+            parent = self.position(parent_id)
+            if parent is None:
+                return False
+            depth, start = self.depths[parent] + 1, parent + 1
+            following = shallower(self.depths[parent]).search(self.depths, start)
+            end = following.start() if following else len(self.ids)
+        if depth > MAX_DEPTH:
+            return False
+
+        # children of the parent are the entries of its subtree at `depth`;
+        # new posts usually have the largest id among them
+        sibling = bytes([depth])
+        last = self.depths.rfind(sibling, start, end)
+        if last < 0 or self.ids[last] < post_id:
+            position = end
+        elif self.ids[last] == post_id:
+            return True
+        else:
+            position = self.depths.find(sibling, start, end)
+            while self.ids[position] < post_id:
+                position = self.depths.find(sibling, position + 1, end)
+            if self.ids[position] == post_id:
+                return True
+        self.ids.insert(position, post_id)
+        self.depths.insert(position, depth)
+        return True
+
+    def tree_page(self, since, limit, is_desc):
+        if since is None:
+            position = -1 if not is_desc else len(self.ids)
+        else:
+            position = self.position(since)
+            if position is None:
+                return None
+        if is_desc:
+            return self.ids[max(position - limit, 0):position][::-1]
+        return self.ids[position + 1:position + 1 + limit]
+
+    def parent_tree_page(self, since, limit, is_desc):
+        if since is None:
+            root = -1 if not is_desc else len(self.ids)
+        else:
+            position = self.position(since)
+            if position is None:
+                return None
+            root = self.depths.rfind(b'\x00', 0, position + 1)
+        if is_desc:
+            start = root
+            for _ in range(limit):
+                start = self.depths.rfind(b'\x00', 0, start)
+                if start < 0:
+                    start = 0
+                    break
+            return self.ids[start:root][::-1]
+
+        start = self.depths.find(b'\x00', root + 1)
+        if start < 0:
+            return []
+        end = start
+        for _ in range(limit):
+            end = self.depths.find(b'\x00', end + 1)
+            if end < 0:
+                end = len(self.ids)
+                break
+        return self.ids[start:end]
+
+
+class TreeIndex:
+    def __init__(self, max_threads):
+        self.max_threads = max_threads
+        self._process_id = None
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+
+    @property
+    def enabled(self):
+        return self.max_threads > 0
+
+    def _ensure_process(self):
+        if self._process_id != getpid():
+            # the parent's trees are not kept up to date by this worker's listener
+            self._lock = threading.Lock()
+            self._trees = OrderedDict()
+            self._unindexable = OrderedDict()
+            self._building = {}
+            self.origin = urandom(4).hex()
+            self._process_id = getpid()
+
+    def page(self, thread_id, sort, since, limit, is_desc):
+        """Post ids of a tree page, or None when the index cannot answer it."""
+        if not self.enabled or not cache.listener.poll():
+            return None
+        if (since is not None and not str(since).isdigit()) or not str(limit).isdigit():
+            return None
+        self._ensure_process()
+        tree = self._get_tree(thread_id)
+        if tree is None:
+            return None
+        since = int(since) if since is not None else None
+        with self._lock:
+            if sort == 'tree':
+                return tree.tree_page(since, int(limit), is_desc)
+            return tree.parent_tree_page(since, int(limit), is_desc)
+
+    def _get_tree(self, thread_id):
+        with self._lock:
+            tree = self._trees.get(thread_id)
+            if tree is not None:
+                self._trees.move_to_end(thread_id)
+                self.hits += 1
+                return tree
+            if thread_id in self._building:
+                return None  # another request is building it
+            if thread_id in self._unindexable:
+                self._unindexable.move_to_end(thread_id)
+                return None
+            self._building[thread_id] = []
+            self.misses += 1
+
+        try:
+            tree = self._build(thread_id)
+        except Exception:
+            with self._lock:
+                self._building.pop(thread_id, None)
+            raise
+        with self._lock:
+            pending = self._building.pop(thread_id)
+            if pending is None:
+                return None
+            # posts notified while the tree was read may or may not be in it
+            if tree is None or not all(tree.insert(post_id, parent_id) for post_id, parent_id in pending):
+                self._remember_unindexable(thread_id)
+                return None
+            self._trees[thread_id] = tree
+            while len(self._trees) > self.max_threads:
+                self._trees.popitem(last=False)
+        return tree
+
+    def _build(self, thread_id):
+        self.builds += 1
+        with get_DB_cursor(primary=True) as cur:
+            cur.execute('''select id, array_length(parent_path, 1) - 2 as depth
+                           from posts where thread_id = %s order by parent_path''', (thread_id,))
+            rows = cur.fetchall()
+        try:
+            return ThreadTree(array('i', [row['id'] for row in rows]), bytearray(row['depth'] for row in rows))
+        except ValueError:
+            return None  # deeper than MAX_DEPTH
+
+    def add(self, thread_id, posts):
+        """Insert `posts` ((id, parent id) pairs, parents first) into the tree of `thread_id`."""
+        if self._process_id != getpid():
+            return
+        with self._lock:
+            pending = self._building.get(thread_id)
+            if pending is not None:
+                pending.extend(posts)
+            tree = self._trees.get(thread_id)
+            if tree is None:
+                return
+            for post_id, parent_id in posts:
+                if not tree.insert(post_id, parent_id):
+                    del self._trees[thread_id]
+                    self._remember_unindexable(thread_id)
+                    return
+
+    def _remember_unindexable(self, thread_id):
+        """Keep later pages of `thread_id` from reading the whole thread only to fall back to SQL again."""
+        self._unindexable[thread_id] = True
+        while len(self._unindexable) > UNINDEXABLE_THREADS:
+            self._unindexable.popitem(last=False)
+
+    def publish(self, cur, thread_id, posts):
+        """Tell the other workers about `posts` once the current transaction commits."""
+        self._ensure_process()
+        for start in range(0, len(posts), NOTIFY_CHUNK_SIZE):
+            chunk = ','.join(f'{post_id}.{parent_id}' for post_id, parent_id in posts[start:start + NOTIFY_CHUNK_SIZE])
+            cur.execute('select pg_notify(%s, %s)',
+                        (cache.CACHE_CHANNEL, f'posts:{self.origin}:{thread_id}:{chunk}'))
+
+    def apply_notification(self, payload):
+        """Handle `<origin>:<thread id>:<id>.<parent id>,...`, or `*` after a bulk load."""
+        if payload == '*':
+            self.clear()
+            return
+        origin, thread_id, posts = payload.split(':')
+        if self._process_id != getpid() or origin == self.origin:
+            return
+        self.add(int(thread_id), [tuple(map(int, post.split('.'))) for post in posts.split(',')])
+
+    def clear(self):
+        if self._process_id == getpid():
+            with self._lock:
+                self._trees.clear()
+                self._unindexable.clear()
+                # builds in flight may have missed anything; drop them too
+                self._building = dict.fromkeys(self._building)
+
+    def stats(self):
+        trees = list(self._trees.values()) if self._process_id == getpid() else []
+        return {
+            'threads': len(trees),
+            'posts': sum(len(tree.ids) for tree in trees),
+            'hits': self.hits,
+            'misses': self.misses,
+            'builds': self.builds,
+            'unindexable': len(self._unindexable) if self._process_id == getpid() else 0,
+        }
+
+
+index = TreeIndex(TREE_INDEX_THREADS)
+cache.on_notification('posts', index.apply_notification)
+cache.on_clear(index.clear)
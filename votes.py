@@ -0,0 +1,103 @@
+"""Coalescing of vote deltas for hot threads.
+
+Every vote row is written immediately, but with coalescing enabled a thread
+that receives more than VOTE_HOT_THRESHOLD votes per flush interval in this
+worker stops updating `threads.votes` on every vote. Its deltas are summed in
+memory and applied by a background thread every VOTE_FLUSH_INTERVAL seconds,
+so voters no longer queue on the thread's row lock. Until a flush, other
+workers do not see this worker's pending deltas, and deltas that have not
+been flushed are lost if the worker is killed.
+"""
+import atexit
+import threading
+import time
+from sys import stderr
+from collections import defaultdict
+from os import environ, getpid
+import cache
+from connect_db import get_DB_cursor
+
+VOTE_FLUSH_INTERVAL = float(environ.get('FORUM_VOTE_FLUSH_INTERVAL', 0))
+VOTE_HOT_THRESHOLD = int(environ.get('FORUM_VOTE_HOT_THRESHOLD', 10))
+
+
+class VoteCoalescer:
+    def __init__(self, interval, hot_threshold):
+        self.interval = interval
+        self.hot_threshold = hot_threshold
+        self._process_id = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def _ensure_worker(self):
+        if self._process_id != getpid():
+            # deltas inherited from the parent are the parent's to flush
+            self._lock = threading.Lock()
+            self._pending = defaultdict(int)
+            self._recent = defaultdict(int)
+            self._process_id = getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def is_hot(self, thread_id):
+        """Count a vote on `thread_id` and tell whether its delta should be coalesced."""
+        if not self.enabled:
+            return False
+        self._ensure_worker()
+        with self._lock:
+            self._recent[thread_id] += 1
+            return self._recent[thread_id] > self.hot_threshold
+
+    def add(self, thread_id, delta):
+        with self._lock:
+            self._pending[thread_id] += delta
+
+    def pending(self, thread_id):
+        if self._process_id != getpid():
+            return 0
+        with self._lock:
+            return self._pending.get(thread_id, 0)
+
+    def flush(self):
+        if self._process_id != getpid():
+            return
+        with self._lock:
+            pending = {thread_id: delta for thread_id, delta in self._pending.items() if delta}
+            self._pending.clear()
+            self._recent.clear()
+        if not pending:
+            return
+        try:
+            with get_DB_cursor() as cur:
+                sql = '''update threads as t set votes = t.votes + d.delta, version = t.version + 1
+                         from unnest(%s::int[], %s::int[]) as d(id, delta)
+                         where t.id = d.id'''
+                cur.execute(sql, (list(pending), list(pending.values())))
+        except Exception:
+            with self._lock:
+                for thread_id, delta in pending.items():
+                    self._pending[thread_id] += delta
+            raise
+        for thread_id in pending:
+            cache.threads.invalidate(thread_id)
+
+    def discard(self):
+        if self._process_id == getpid():
+            with self._lock:
+                self._pending.clear()
+                self._recent.clear()
+
+    def _run(self):
+        process_id = getpid()
+        while self._process_id == process_id:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as error:
+                print(error, file=stderr)  # kept pending, retried on the next tick
+
+
+coalescer = VoteCoalescer(VOTE_FLUSH_INTERVAL, VOTE_HOT_THRESHOLD)
+atexit.register(coalescer.flush)
+cache.on_reset(coalescer.discard)